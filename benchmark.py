@@ -0,0 +1,595 @@
+"""Benchmark of the catalog's HTML and API routes.
+
+Seeds a database with generated users, categories and items, then
+requests each route through the Flask test client and through a real
+WSGI server, and reports throughput, latency percentiles and SQL
+statements per request. By default a new SQLite file is used:
+
+    python benchmark.py --users 10 --categories 10 --items 100
+
+To use a throwaway PostgreSQL database instead, pass its URL. Data is
+only generated if the database has no benchmark users yet, so later runs
+reuse it. Pass --reset to delete all rows first:
+
+    python benchmark.py --database-url postgresql:///catalog_bench --reset
+
+Save the results of a run with --save-baseline results.json, and compare
+a later run against them with --baseline results.json. The comparison
+fails with exit status 1 if a route got slower than the tolerance allows
+or runs more SQL statements than before.
+
+--encoding-rows times how the item list API reads and encodes rows, with
+whole ORM instances or selected columns, and Flask's encoder or orjson.
+It reports rows per second and peak memory. For 100k items:
+
+    python benchmark.py --users 10 --categories 10 --items 1000 \
+        --encoding-rows 100000 --server none --startup-runs 0
+
+--delete-items times deleting a category of that many items through the
+API, with its SQL statements and peak memory:
+
+    python benchmark.py --delete-items 50000 --server none --startup-runs 0
+"""
+import argparse
+import base64
+import datetime
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.urls import url_quote
+
+PASSWORD = 'benchmark'
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url',
+                        help='database to seed, defaults to a new SQLite file')
+    parser.add_argument('--reset', action='store_true',
+                        help='delete all rows of the database before seeding')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--categories', type=int, default=10,
+                        help='categories per user')
+    parser.add_argument('--items', type=int, default=20,
+                        help='items per category')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per route and server')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='client threads against the WSGI server')
+    parser.add_argument('--server',
+                        choices=['client', 'wsgi', 'both', 'none'],
+                        default='both')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for generated data and request order')
+    parser.add_argument('--baseline', help='compare with this results file')
+    parser.add_argument('--save-baseline', help='write results to this file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 slowdown against the baseline')
+    parser.add_argument('--startup-runs', type=int, default=3,
+                        help='fresh processes started to time startup')
+    parser.add_argument('--encoding-rows', type=int, default=0,
+                        help='items read and encoded by the encoding '
+                             'benchmark, 0 to skip it')
+    parser.add_argument('--delete-items', type=int, default=0,
+                        help='items of the category deleted by the delete '
+                             'benchmark, 0 to skip it')
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    # The app reads its configuration when it is first imported
+    if args.database_url is None:
+        handle, path = tempfile.mkstemp(prefix='catalog_bench_',
+                                        suffix='.db')
+        os.close(handle)
+        args.database_url = 'sqlite:///%s' % path
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, REPO_DIR)
+
+
+###########
+# Seeding #
+###########
+
+def seed(args):
+    """Fill the database, returning the ids and names used by the routes"""
+    from sqlalchemy import func, select
+    from item_catalog_app.database import get_engine
+    from item_catalog_app.models import Category, Item, UserAccount
+
+    from item_catalog_app.migrations import init_db
+
+    init_db()
+    users = UserAccount.__table__
+    categories = Category.__table__
+    items = Item.__table__
+    rng = random.Random(args.seed)
+
+    with get_engine().begin() as conn:
+        if args.reset:
+            for table in (items, categories, users):
+                conn.execute(table.delete())
+        if conn.execute(select([func.count()]).where(
+                users.c.user_name == 'bench0')).scalar() == 0:
+            # Hashing is slow on purpose, so all users share one hash
+            holder = UserAccount()
+            holder.hash_password(PASSWORD)
+            conn.execute(users.insert(), [
+                {'user_name': 'bench%d' % u,
+                 'user_email': 'bench%d@example.com' % u,
+                 'password_hash': holder.password_hash}
+                for u in range(args.users)])
+            user_ids = [row[0] for row in conn.execute(
+                users.select().with_only_columns([users.c.user_id]))]
+            conn.execute(categories.insert(), [
+                {'category_name': 'Category %d-%d' % (u, c),
+                 'user_id': user_id}
+                for u, user_id in enumerate(user_ids)
+                for c in range(args.categories)])
+            category_ids = [row[0] for row in conn.execute(
+                categories.select().with_only_columns(
+                    [categories.c.category_id]))]
+            start = datetime.datetime(2019, 1, 1)
+            rows = []
+            for category_id in category_ids:
+                for i in range(args.items):
+                    rows.append({
+                        'item_name': 'Item %d-%d' % (category_id, i),
+                        'item_description': 'Description of item %d in '
+                                            'category %d' % (i, category_id),
+                        'item_price_cents': rng.randint(100, 100000),
+                        'item_date': start + datetime.timedelta(
+                            seconds=len(rows)),
+                        'category_id': category_id})
+                    if len(rows) % 1000 == 0:
+                        conn.execute(items.insert(), rows[-1000:])
+            if len(rows) % 1000:
+                conn.execute(items.insert(), rows[-(len(rows) % 1000):])
+
+        category_rows = conn.execute(categories.select()).fetchall()
+        item_rows = conn.execute(select(
+            [items.c.item_id, items.c.item_name, items.c.category_id]
+        ).order_by(items.c.item_id).limit(1000)).fetchall()
+    return {'categories': [(r.category_id, r.category_name)
+                           for r in category_rows],
+            'items': [(r.item_id, r.item_name, r.category_id)
+                      for r in item_rows]}
+
+
+##########
+# Routes #
+##########
+
+def quote(name):
+    return url_quote(name, safe='')
+
+
+def basic_auth(user_name, password):
+    credentials = ('%s:%s' % (user_name, password)).encode('utf-8')
+    return {'Authorization': 'Basic ' +
+            base64.b64encode(credentials).decode('ascii')}
+
+
+def make_routes(data, token):
+    """Routes as (name, function of a random generator returning
+    (path, headers, json body))
+    """
+    password_headers = basic_auth('bench0', PASSWORD)
+    token_headers = basic_auth(token, 'unused')
+    categories = data['categories']
+    items = data['items']
+    category_names = dict(categories)
+
+    def category_page(rng):
+        category_id, name = rng.choice(categories)
+        return '/catalog/%s/%d' % (quote(name), category_id), {}, None
+
+    def item_page(rng):
+        item_id, name, category_id = rng.choice(items)
+        return ('/catalog/%s/%s/%d' % (quote(category_names[category_id]),
+                                       quote(name), item_id), {}, None)
+
+    def item_api(headers):
+        def request(rng):
+            return ('/api/catalog/item', headers,
+                    {'id': rng.choice(items)[0]})
+        return request
+
+    def items_by_id(rng):
+        ids = rng.sample(items, min(20, len(items)))
+        return ('/api/catalog/item?fields=item_name,item_price&ids=' +
+                ','.join(str(item[0]) for item in ids), token_headers, None)
+
+    return [
+        ('catalog', lambda rng: ('/catalog', {}, None)),
+        ('showCategory', category_page),
+        ('showItem', item_page),
+        ('api items', lambda rng: ('/api/catalog/items', {}, None)),
+        ('api items by price',
+         lambda rng: ('/api/catalog/items?sort=price&min_price=100', {},
+                      None)),
+        ('api item, password', item_api(password_headers)),
+        ('api item, token', item_api(token_headers)),
+        ('api items by id', items_by_id),
+    ]
+
+
+###########
+# Runners #
+###########
+
+WARMUP_REQUESTS = 5
+
+
+def percentile(latencies, p):
+    # Nearest rank: the smallest value that p percent of values are at most
+    ranked = sorted(latencies)
+    return ranked[max(0, int(math.ceil(p / 100.0 * len(ranked))) - 1)]
+
+
+def summarize(latencies, elapsed, statements, errors):
+    return {'requests': len(latencies),
+            'throughput': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'statements': round(float(statements) / len(latencies), 2),
+            'errors': errors}
+
+
+def failed(status, body):
+    # API errors are JSON objects with an error key and status 200
+    return status >= 400 or body.startswith(b'{"error"')
+
+
+def run_test_client(app, routes, args):
+    """Requests one after another, in this process, without HTTP"""
+    from item_catalog_app.database import count_queries
+
+    client = app.test_client()
+    results = {}
+    for name, make_request in routes:
+        rng = random.Random(args.seed)
+
+        def send():
+            path, headers, body = make_request(rng)
+            response = client.open(path, method='GET', headers=headers,
+                                   json=body)
+            return failed(response.status_code, response.get_data())
+
+        for _ in range(WARMUP_REQUESTS):
+            send()
+        latencies = []
+        errors = 0
+        with count_queries() as counter:
+            start = time.time()
+            for _ in range(args.requests):
+                sent = time.time()
+                errors += send()
+                latencies.append(time.time() - sent)
+            elapsed = time.time() - start
+        results[name] = summarize(latencies, elapsed, counter['count'],
+                                  errors)
+    return results
+
+
+def run_wsgi_server(app, routes, args):
+    """Concurrent HTTP requests to a threaded WSGI server"""
+    import logging
+    import requests
+    from werkzeug.serving import make_server
+    from item_catalog_app.database import count_queries
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+    sessions = threading.local()
+
+    def send(request):
+        path, headers, body = request
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        sent = time.time()
+        response = sessions.session.get(base_url + path, headers=headers,
+                                        json=body)
+        return (time.time() - sent,
+                failed(response.status_code, response.content))
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for name, make_request in routes:
+                rng = random.Random(args.seed)
+                for _ in range(WARMUP_REQUESTS):
+                    send(make_request(rng))
+                planned = [make_request(rng) for _ in range(args.requests)]
+                with count_queries() as counter:
+                    start = time.time()
+                    timings = list(executor.map(send, planned))
+                    elapsed = time.time() - start
+                results[name] = summarize(
+                    [latency for latency, error in timings], elapsed,
+                    counter['count'], sum(error for latency, error in timings))
+    finally:
+        server.shutdown()
+    return results
+
+
+def encoding_variants():
+    """Ways to turn items into a JSON response, as (name, read rows,
+    serialize a row, encoder)"""
+    from item_catalog_app.models import Item
+    from item_catalog_app.views import ITEM_COLUMNS, ITEM_ORDER, session
+
+    def instances(limit):
+        return session.query(Item).order_by(*ITEM_ORDER).limit(limit).all()
+
+    def columns(limit):
+        return session.query(*ITEM_COLUMNS).order_by(
+            *ITEM_ORDER).limit(limit).all()
+
+    def serialize(item):
+        return item.serialize
+
+    return [
+        ('orm, flask', instances, serialize, 'flask'),
+        ('orm, orjson', instances, serialize, 'orjson'),
+        ('columns, flask', columns, Item.serialize_row, 'flask'),
+        ('columns, orjson', columns, Item.serialize_row, 'orjson'),
+    ]
+
+
+def measure_encoding(app, args):
+    """Rows per second and peak memory of building one response of
+    --encoding-rows items, for each variant"""
+    from item_catalog_app import encoding
+    from item_catalog_app.database import db_session
+
+    def respond(read, serialize, limit):
+        rows = read(limit)
+        response = encoding.jsonify(items=[serialize(r) for r in rows])
+        db_session.remove()
+        return len(rows), len(response.get_data())
+
+    results = {}
+    encoder = app.config['API_JSON_ENCODER']
+    try:
+        with app.app_context():
+            for name, read, serialize, encoder_name in encoding_variants():
+                app.config['API_JSON_ENCODER'] = encoder_name
+                if encoder_name == 'orjson' and not encoding.use_orjson():
+                    continue
+                respond(read, serialize, WARMUP_REQUESTS)
+                start = time.time()
+                rows, size = respond(read, serialize, args.encoding_rows)
+                elapsed = time.time() - start
+                # Tracing slows Python down, so memory is a separate run
+                tracemalloc.start()
+                respond(read, serialize, args.encoding_rows)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                results[name] = {'rows': rows,
+                                 'rows_per_sec': round(rows / elapsed),
+                                 'peak_mb': round(peak / 1e6, 1),
+                                 'response_mb': round(size / 1e6, 1)}
+    finally:
+        app.config['API_JSON_ENCODER'] = encoder
+    return results
+
+
+def create_category(name, items):
+    """Insert a category of bench0 with that many items, returning its id"""
+    from sqlalchemy import select
+    from item_catalog_app.database import get_engine
+    from item_catalog_app.models import Category, Item, UserAccount
+
+    users = UserAccount.__table__
+    with get_engine().begin() as conn:
+        user_id = conn.execute(select([users.c.user_id]).where(
+            users.c.user_name == 'bench0')).scalar()
+        category_id = conn.execute(Category.__table__.insert().values(
+            category_name=name, user_id=user_id)).inserted_primary_key[0]
+        for start in range(0, items, 1000):
+            conn.execute(Item.__table__.insert(), [
+                {'item_name': 'Deleted item %d' % i,
+                 'item_description': 'Item %d of a deleted category' % i,
+                 'item_price_cents': 100,
+                 'category_id': category_id}
+                for i in range(start, min(start + 1000, items))])
+    return category_id
+
+
+def measure_delete(app, token, args):
+    """Time, SQL statements and peak memory of deleting a category of
+    --delete-items items with the API"""
+    from item_catalog_app.database import count_queries
+
+    client = app.test_client()
+
+    def delete(traced):
+        category_id = create_category(
+            'Deleted category %s' % time.time(), args.delete_items)
+        if traced:
+            tracemalloc.start()
+        with count_queries() as counter:
+            start = time.time()
+            response = client.delete('/api/catalog/category',
+                                     headers=basic_auth(token, 'unused'),
+                                     json={'id': category_id})
+            elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1] if traced else None
+        tracemalloc.stop()
+        if failed(response.status_code, response.get_data()):
+            raise RuntimeError('Delete failed: %s' % response.get_data())
+        return elapsed, counter['count'], peak
+
+    elapsed, statements, _ = delete(False)
+    # Tracing slows Python down, so memory is a separate run
+    peak = delete(True)[2]
+    return {'items': args.delete_items, 'seconds': round(elapsed, 3),
+            'statements': statements, 'peak_mb': round(peak / 1e6, 1)}
+
+
+# Run in a new interpreter, so nothing is imported or connected yet
+STARTUP_SCRIPT = '''
+import json, time
+start = time.time()
+from item_catalog_app import create_app
+app = create_app()
+imported = time.time()
+app.test_client().get('/api/catalog/categories')
+print(json.dumps({'import_ms': (imported - start) * 1000,
+                  'first_request_ms': (time.time() - imported) * 1000}))
+'''
+
+
+def measure_startup(args):
+    """Fastest import and first request time of several new processes"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+    runs = []
+    for _ in range(args.startup_runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT], env=env)
+        runs.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    return dict((key, round(min(run[key] for run in runs), 1))
+                for key in ('import_ms', 'first_request_ms'))
+
+
+#############
+# Reporting #
+#############
+
+COLUMNS = ('throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'statements',
+           'errors')
+
+
+def print_results(results):
+    for mode, routes in sorted(results.items()):
+        print('\n%s' % mode)
+        print('%-22s' % 'route' + ''.join('%12s' % c for c in COLUMNS))
+        for name, summary in routes.items():
+            print('%-22s' % name +
+                  ''.join('%12s' % summary[c] for c in COLUMNS))
+
+
+def print_startup(startup):
+    print('\nstartup: import %s ms, first request %s ms' % (
+        startup['import_ms'], startup['first_request_ms']))
+
+
+ENCODING_COLUMNS = ('rows', 'rows_per_sec', 'peak_mb', 'response_mb')
+
+
+def print_encoding(encoding):
+    print('\nencoding')
+    print('%-22s' % 'variant' + ''.join('%14s' % c for c in ENCODING_COLUMNS))
+    for name, summary in encoding.items():
+        print('%-22s' % name +
+              ''.join('%14s' % summary[c] for c in ENCODING_COLUMNS))
+
+
+def print_delete(delete):
+    print('\ndelete: category of %s items in %s s, %s SQL statements, '
+          '%s MB peak' % (delete['items'], delete['seconds'],
+                          delete['statements'], delete['peak_mb']))
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against the baseline"""
+    regressions = []
+    startup = results.get('startup')
+    if startup and 'startup' in baseline:
+        for key in ('import_ms', 'first_request_ms'):
+            before = baseline['startup'][key]
+            if startup[key] > before * (1 + tolerance):
+                regressions.append('startup %s: %s, was %s' % (
+                    key, startup[key], before))
+    for name, summary in results.get('encoding', {}).items():
+        before = baseline.get('encoding', {}).get(name)
+        if before is None or before['rows'] != summary['rows']:
+            continue
+        if summary['rows_per_sec'] < before['rows_per_sec'] / (1 + tolerance):
+            regressions.append('encoding %s: %s rows/s, was %s' % (
+                name, summary['rows_per_sec'], before['rows_per_sec']))
+    delete = results.get('delete')
+    before = baseline.get('delete')
+    if delete and before and before['items'] == delete['items']:
+        if delete['seconds'] > before['seconds'] * (1 + tolerance):
+            regressions.append('delete: %s s, was %s s' % (
+                delete['seconds'], before['seconds']))
+    for mode, routes in results.items():
+        if mode in ('startup', 'encoding', 'delete'):
+            continue
+        for name, summary in routes.items():
+            before = baseline.get(mode, {}).get(name)
+            if before is None:
+                continue
+            if summary['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                regressions.append('%s %s: p95 %s ms, was %s ms' % (
+                    mode, name, summary['p95_ms'], before['p95_ms']))
+            if summary['statements'] > before['statements']:
+                regressions.append('%s %s: %s SQL statements, was %s' % (
+                    mode, name, summary['statements'], before['statements']))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    from item_catalog_app import app
+
+    data = seed(args)
+    client = app.test_client()
+    response = client.get('/api/token',
+                          headers=basic_auth('bench0', PASSWORD))
+    token = json.loads(response.get_data(as_text=True))['token']
+    routes = make_routes(data, token)
+
+    results = {}
+    if args.server in ('client', 'both'):
+        results['test client'] = run_test_client(app, routes, args)
+    if args.server in ('wsgi', 'both'):
+        results['wsgi server'] = run_wsgi_server(app, routes, args)
+    print('Database %s' % args.database_url)
+    print_results(results)
+    if args.encoding_rows:
+        results['encoding'] = measure_encoding(app, args)
+        print_encoding(results['encoding'])
+    if args.delete_items:
+        results['delete'] = measure_delete(app, token, args)
+        print_delete(results['delete'])
+    if args.startup_runs:
+        results['startup'] = measure_startup(args)
+        print_startup(results['startup'])
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('\nRegressions against %s:' % args.baseline)
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('\nNo regressions against %s' % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,5 +2,93 @@ import os
 
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY')
+    # Comma separated keys that were used before the current SECRET_KEY,
+    # API tokens signed with them are still accepted
+    SECRET_KEY_PREVIOUS = [
+        key for key in os.environ.get('SECRET_KEY_PREVIOUS', '').split(',')
+        if key]
     # FLASK_ENV = 'development'
     DATABASE_URL = os.environ.get('DATABASE_URL')
+    # Comma separated URLs of read replicas of DATABASE_URL. GET requests
+    # read from them in turn, skipping replicas that fail health checks.
+    DATABASE_REPLICA_URLS = [
+        url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if url]
+    DATABASE_REPLICA_CHECK_INTERVAL = int(
+        os.environ.get('DATABASE_REPLICA_CHECK_INTERVAL', 10))
+    # Seconds the replicas may lag behind. A browser session reads from the
+    # primary this long after it writes, and pages read from a replica are
+    # cached this long only.
+    DATABASE_REPLICA_LAG = int(os.environ.get('DATABASE_REPLICA_LAG', 10))
+
+    # Connection pool settings for the shared database engine
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true') == 'true'
+
+    # Page sizes for the paginated API list endpoints
+    API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', 100))
+    API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 1000))
+
+    # Largest number of operations accepted by the batch API endpoints
+    API_MAX_BATCH_SIZE = int(os.environ.get('API_MAX_BATCH_SIZE', 1000))
+
+    # Encoder of the API list endpoints: 'orjson', used when the orjson
+    # package is installed, or 'flask' for Flask's own encoder
+    API_JSON_ENCODER = os.environ.get('API_JSON_ENCODER', 'orjson')
+
+    # Recently verified API credentials are kept for AUTH_CACHE_TTL seconds
+    AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 1024))
+    AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 300))
+
+    # Cache of pages rendered for anonymous visitors: 'local' keeps them in
+    # each process, 'redis' shares them at RESPONSE_CACHE_URL, 'none'
+    # turns the cache off
+    RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'local')
+    RESPONSE_CACHE_URL = os.environ.get(
+        'RESPONSE_CACHE_URL', 'redis://localhost:6379/0')
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+
+    # Google OAuth client file and endpoints, which may point to a local
+    # stub provider (see oauth_stub.py) for offline load tests
+    CLIENT_SECRETS_FILE = os.environ.get(
+        'CLIENT_SECRETS_FILE',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     'client_secrets.json'))
+    OAUTH_TOKENINFO_URL = os.environ.get(
+        'OAUTH_TOKENINFO_URL', 'https://www.googleapis.com/oauth2/v1/tokeninfo')
+    OAUTH_USERINFO_URL = os.environ.get(
+        'OAUTH_USERINFO_URL', 'https://www.googleapis.com/oauth2/v1/userinfo')
+    OAUTH_REVOKE_URL = os.environ.get(
+        'OAUTH_REVOKE_URL', 'https://accounts.google.com/o/oauth2/revoke')
+    # Seconds to wait on the OAuth provider, and connections kept per host
+    OAUTH_HTTP_TIMEOUT = float(os.environ.get('OAUTH_HTTP_TIMEOUT', 5))
+    OAUTH_HTTP_POOL_SIZE = int(os.environ.get('OAUTH_HTTP_POOL_SIZE', 10))
+    # Certificates to verify Google ID tokens locally, how long to keep
+    # them when Google does not say, and seconds to wait before trying
+    # again when they cannot be downloaded
+    GOOGLE_CERTS_URL = os.environ.get(
+        'GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+    GOOGLE_CERTS_MAX_AGE = int(os.environ.get('GOOGLE_CERTS_MAX_AGE', 3600))
+    GOOGLE_CERTS_RETRY = int(os.environ.get('GOOGLE_CERTS_RETRY', 60))
+
+    # Least severe level written to the log, and records held for the log
+    # writer thread before new ones are dropped
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+    # Send a Server-Timing header with the time spent in SQL, templates and
+    # outbound HTTP calls, for browser developer tools
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', 'false') == 'true'
+
+    # Open event streams per worker process, events buffered for each
+    # before it reads the change log again, seconds between polls of the
+    # change log for writes of other processes, and seconds between
+    # keep-alive comments on an idle stream
+    EVENTS_MAX_SUBSCRIBERS = int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', 100))
+    EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))
+    EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 2))
+    EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
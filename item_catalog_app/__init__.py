@@ -4,4 +4,21 @@ from config import Config
 app = Flask(__name__)
 app.config.from_object(Config)
 
-from item_catalog_app import views
+
+def create_app(config=None):
+    """Return the app with the given settings applied over Config.
+
+    Importing the app does no I/O. The database engine and replicas are
+    created for the first request that needs them, and the OAuth client
+    file is read on the first login, so only the DATABASE_*, DB_POOL_*
+    and CLIENT_SECRETS_FILE settings can be changed here. The caches,
+    logging, event streams and OAuth HTTP session are set up from Config
+    when the app is imported, so set RESPONSE_CACHE_*, AUTH_CACHE_*,
+    LOG_*, EVENTS_* and OAUTH_HTTP_* in the environment instead.
+    """
+    if config:
+        app.config.update(config)
+    return app
+
+
+from item_catalog_app import logs, metrics, views, migrations
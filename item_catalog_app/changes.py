@@ -0,0 +1,129 @@
+from sqlalchemy import event, inspect, literal, or_
+from sqlalchemy.orm import Query
+
+from item_catalog_app.database import AppSession
+from item_catalog_app.models import Category, Change, Item, UserAccount
+
+
+# Models whose writes are logged, with their name in the change feed.
+# Parents are logged first, except on delete.
+LOGGED_MODELS = [(Category, 'category'), (Item, 'item')]
+
+# PostgreSQL advisory lock key of the change log
+CHANGE_LOG_LOCK = 7301
+
+
+def record_changes(session, model, operation, rows):
+    """Append changes to the log, in the transaction of the write.
+
+    rows are (id, category_id) pairs, the category of a category being
+    itself, or a query of such pairs, copied with one INSERT ... SELECT.
+    """
+    entity = dict(LOGGED_MODELS)[model]
+    columns = ['entity', 'entity_id', 'category_id', 'operation']
+    if isinstance(rows, Query):
+        entity_id, category_id = [c['expr'] for c in rows.column_descriptions]
+        insert = Change.__table__.insert().from_select(
+            columns, rows.with_entities(
+                literal(entity), entity_id.label('entity_id'),
+                category_id.label('category_id'), literal(operation)
+            ).order_by(entity_id).statement)
+        values = None
+    else:
+        insert = Change.__table__.insert()
+        values = [dict(zip(columns, (entity, entity_id, category_id,
+                                     operation)))
+                  for entity_id, category_id in rows]
+        if not values:
+            return
+    if session.get_bind().dialect.name == 'postgresql':
+        # Writers hold the lock until they commit, so changes become
+        # visible in the order of their numbers and readers skip none
+        session.execute('SELECT pg_advisory_xact_lock(%d)' % CHANGE_LOG_LOCK)
+    session.execute(insert, values)
+    # Lets the event streams know right after the commit
+    session.info['changes_recorded'] = True
+
+
+def primary_key(obj):
+    return inspect(obj).mapper.primary_key_from_instance(obj)[0]
+
+
+# Rows deleted by ON DELETE CASCADE never reach the session, so they are
+# logged from the database before the flush deletes their parents
+@event.listens_for(AppSession, 'before_flush')
+def logCascadedDeletes(session, flush_context, instances):
+    user_ids = [obj.user_id for obj in session.deleted
+                if isinstance(obj, UserAccount)]
+    category_ids = [obj.category_id for obj in session.deleted
+                    if isinstance(obj, Category)]
+    parents = []
+    if category_ids:
+        parents.append(Item.category_id.in_(category_ids))
+    if user_ids:
+        user_categories = session.query(Category.category_id).filter(
+            Category.user_id.in_(user_ids))
+        parents.append(Item.category_id.in_(user_categories.subquery()))
+    if parents:
+        record_changes(session, Item, 'delete', session.query(
+            Item.item_id, Item.category_id).filter(or_(*parents)))
+    if user_ids:
+        record_changes(session, Category, 'delete', session.query(
+            Category.category_id, Category.category_id).filter(
+            Category.user_id.in_(user_ids)))
+
+
+# Log every category and item written through the ORM, except deletes
+# logged above as part of a deleted parent
+@event.listens_for(AppSession, 'after_flush')
+def logFlushedChanges(session, flush_context):
+    dirty = [obj for obj in session.dirty
+             if session.is_modified(obj, include_collections=False)]
+    user_ids = set(obj.user_id for obj in session.deleted
+                   if isinstance(obj, UserAccount))
+    category_ids = set(obj.category_id for obj in session.deleted
+                       if isinstance(obj, Category))
+    deleted = [obj for obj in session.deleted
+               if not (isinstance(obj, Category) and
+                       obj.user_id in user_ids) and
+               not (isinstance(obj, Item) and
+                    obj.category_id in category_ids)]
+    for operation, objects in (('insert', session.new),
+                               ('update', dirty),
+                               ('delete', deleted)):
+        models = [model for model, entity in LOGGED_MODELS]
+        if operation == 'delete':
+            models.reverse()
+        for model in models:
+            record_changes(session, model, operation,
+                           [(primary_key(obj), obj.category_id)
+                            for obj in objects if isinstance(obj, model)])
+
+
+def changes_since(session, since, limit):
+    """Return up to limit changes after number since, and if more follow"""
+    changes = session.query(Change).filter(
+        Change.change_id > since).order_by(
+        Change.change_id).limit(limit + 1).all()
+    return changes[:limit], len(changes) > limit
+
+
+def change_entries(session, changes):
+    """Changes as dicts, with the current data of inserted and updated
+    rows. A row deleted since then has a later delete change."""
+    current = {}
+    for model, entity in LOGGED_MODELS:
+        ids = set(c.entity_id for c in changes
+                  if c.entity == entity and c.operation != 'delete')
+        if ids:
+            key = inspect(model).primary_key[0]
+            for row in session.query(model).filter(key.in_(ids)):
+                current[(entity, getattr(row, key.name))] = row.serialize
+    return [{'seq': c.change_id,
+             'entity': c.entity,
+             'id': c.entity_id,
+             'category_id': c.category_id,
+             'op': c.operation,
+             'changed_at': c.changed_at,
+             'data': current.get((c.entity, c.entity_id))}
+            for c in changes]
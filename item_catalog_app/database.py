@@ -0,0 +1,290 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from flask import session as login_session
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import UpdateBase
+
+from item_catalog_app import app
+
+
+class PoolMetrics(object):
+    """Counters for connection checkouts and time spent waiting on the pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self, pool=None):
+        with self._lock:
+            data = {
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'connects': self.connects,
+                'timeouts': self.timeouts,
+                'wait_total_seconds': round(self.wait_total, 6),
+                'wait_max_seconds': round(self.wait_max, 6)
+            }
+        if isinstance(pool, QueuePool):
+            data.update({
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow()
+            })
+        return data
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a slot"""
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            conn = super(InstrumentedQueuePool, self)._do_get()
+        except Exception:
+            pool_metrics.record_wait(time.time() - start, timed_out=True)
+            raise
+        pool_metrics.record_wait(time.time() - start)
+        return conn
+
+
+def make_engine(config, url=None):
+    url = make_url(url or config['DATABASE_URL'])
+    options = {}
+    # SQLite picks its own pool class; only tune real database servers
+    if url.get_backend_name() != 'sqlite':
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=config['DB_POOL_SIZE'],
+            max_overflow=config['DB_MAX_OVERFLOW'],
+            pool_timeout=config['DB_POOL_TIMEOUT'],
+            pool_recycle=config['DB_POOL_RECYCLE'],
+            pool_pre_ping=config['DB_POOL_PRE_PING'])
+    new_engine = create_engine(url, **options)
+
+    @event.listens_for(new_engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        pool_metrics.incr('connects')
+
+    if url.get_backend_name() == 'sqlite':
+        # SQLite only enforces foreign keys, and deletes rows with ON
+        # DELETE CASCADE, on connections that ask for it
+        @event.listens_for(new_engine, 'connect')
+        def enable_foreign_keys(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+    @event.listens_for(new_engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_metrics.incr('checkouts')
+
+    @event.listens_for(new_engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        pool_metrics.incr('checkins')
+
+    return new_engine
+
+
+# One engine shared by models and views for the whole process, created
+# when the first request needs it rather than when the app is imported
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = make_engine(app.config)
+    return _engine
+
+
+class ReplicaSet(object):
+    """Read replica engines, used in turn while they pass health checks"""
+
+    def __init__(self, engines, check_interval):
+        self.engines = engines
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._healthy = list(engines)
+        self._turn = 0
+
+    def choose(self):
+        """Return the next healthy replica, or None if there is none"""
+        with self._lock:
+            if not self._healthy:
+                return None
+            self._turn = (self._turn + 1) % len(self._healthy)
+            return self._healthy[self._turn]
+
+    def mark_down(self, engine):
+        with self._lock:
+            if engine in self._healthy:
+                self._healthy.remove(engine)
+
+    def check(self):
+        healthy = []
+        for engine in self.engines:
+            try:
+                with engine.connect() as conn:
+                    conn.execute('SELECT 1')
+                healthy.append(engine)
+            except SQLAlchemyError:
+                pass
+        with self._lock:
+            self._healthy = healthy
+
+    def watch(self):
+        """Check the replicas every check_interval seconds in a thread"""
+        def run():
+            while True:
+                time.sleep(self.check_interval)
+                self.check()
+        thread = threading.Thread(target=run, name='replica-health-check')
+        thread.daemon = True
+        thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {'replicas': len(self.engines),
+                    'healthy': len(self._healthy)}
+
+
+def make_replicas(config):
+    replicas = ReplicaSet(
+        [make_engine(config, url) for url in config['DATABASE_REPLICA_URLS']],
+        config['DATABASE_REPLICA_CHECK_INTERVAL'])
+    for replica in replicas.engines:
+        # Stop using a replica as soon as it cannot be reached, until the
+        # next health check finds it back
+        @event.listens_for(replica, 'handle_error')
+        def on_error(context, replica=replica):
+            if (context.is_disconnect or isinstance(
+                    context.sqlalchemy_exception, OperationalError)):
+                replicas.mark_down(replica)
+    if replicas.engines:
+        replicas.check()
+        replicas.watch()
+    return replicas
+
+
+_replicas = None
+
+
+def get_replicas():
+    global _replicas
+    if _replicas is None:
+        with _engine_lock:
+            if _replicas is None:
+                _replicas = make_replicas(app.config)
+    return _replicas
+
+
+# Methods of requests that only read, and may use a replica
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+@app.before_request
+def routeReads():
+    # After a write, the same browser session reads from the primary until
+    # the replicas have caught up
+    g.read_replica = (
+        bool(app.config['DATABASE_REPLICA_URLS']) and
+        request.method in READ_METHODS and
+        login_session.get('primary_until', 0) < time.time())
+
+
+@app.after_request
+def rememberWrites(response):
+    if (app.config['DATABASE_REPLICA_URLS'] and
+            request.method not in READ_METHODS and
+            response.status_code < 400):
+        login_session['primary_until'] = (
+            time.time() + app.config['DATABASE_REPLICA_LAG'])
+    return response
+
+
+def request_replica():
+    """The replica the current request reads from, or None"""
+    if not has_request_context() or not g.get('read_replica'):
+        return None
+    if 'replica' not in g:
+        g.replica = get_replicas().choose()
+    return g.replica
+
+
+def use_primary():
+    """Read from the primary for the rest of the request.
+
+    Returns whether the request was reading from a replica before.
+    """
+    was_on_replica = request_replica() is not None
+    if has_request_context():
+        g.read_replica = False
+    return was_on_replica
+
+
+class AppSession(Session):
+    """Session that uses the shared engine, creating it if needed.
+
+    Reads of GET requests go to a replica, when there are any.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not isinstance(clause, UpdateBase):
+            replica = request_replica()
+            if replica is not None:
+                return replica
+        return get_engine()
+
+
+# Session bound to the current request, removed on app context teardown
+db_session = scoped_session(sessionmaker(class_=AppSession))
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements executed on any engine inside the block"""
+    counter = {'count': 0}
+
+    def before_cursor_execute(conn, cursor, statement, parameters,
+                              context, executemany):
+        counter['count'] += 1
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    db_session.remove()
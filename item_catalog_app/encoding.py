@@ -0,0 +1,57 @@
+import re
+
+from flask import jsonify as flask_jsonify
+
+from item_catalog_app import app
+
+try:
+    # Optional dependency, Flask's encoder is used without it
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def use_orjson():
+    return orjson is not None and app.config['API_JSON_ENCODER'] == 'orjson'
+
+
+def encode_default(value):
+    # Dates and other values orjson leaves to us are written the way
+    # Flask's encoder writes them, so both encoders return the same JSON
+    return app.json_encoder().default(value)
+
+
+NON_ASCII = re.compile('[^\x00-\x7f]')
+
+
+def escape_non_ascii(match):
+    # The escapes of Python's json module, which writes characters beyond
+    # the Basic Multilingual Plane as surrogate pairs
+    code = ord(match.group())
+    if code < 0x10000:
+        return '\\u%04x' % code
+    code -= 0x10000
+    return '\\u%04x\\u%04x' % (0xd800 | code >> 10, 0xdc00 | code & 0x3ff)
+
+
+def dumps(data):
+    """Encode data as compact JSON bytes"""
+    option = orjson.OPT_PASSTHROUGH_DATETIME
+    if app.config['JSON_SORT_KEYS']:
+        option |= orjson.OPT_SORT_KEYS
+    body = orjson.dumps(data, default=encode_default, option=option)
+    # orjson always writes UTF-8, Flask escapes it unless JSON_AS_ASCII is
+    # off. Non-ASCII bytes only occur inside strings.
+    if app.config['JSON_AS_ASCII'] and not body.isascii():
+        body = NON_ASCII.sub(escape_non_ascii,
+                             body.decode('utf-8')).encode('ascii')
+    return body
+
+
+def jsonify(**kwargs):
+    """jsonify for large API responses, with orjson when it is installed
+    and API_JSON_ENCODER is 'orjson'"""
+    if not use_orjson():
+        return flask_jsonify(**kwargs)
+    return app.response_class(dumps(kwargs) + b'\n',
+                              mimetype=app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,185 @@
+import queue
+import threading
+
+from flask import json
+from sqlalchemy import event
+
+from item_catalog_app import app
+from item_catalog_app.changes import change_entries, changes_since
+from item_catalog_app.database import AppSession, db_session
+from item_catalog_app.logs import log, fields
+
+
+# Changes read from the log at once, when polling or catching up
+EVENT_BATCH_SIZE = 1000
+
+
+def read_changes(since):
+    """Entries of the changes after since, one batch at a time.
+
+    Each batch is read with a short lived session, so no connection is
+    held while the caller sends it, and only one batch is in memory.
+    """
+    while True:
+        try:
+            changes, more = changes_since(db_session, since,
+                                          EVENT_BATCH_SIZE)
+            entries = change_entries(db_session, changes)
+        finally:
+            db_session.remove()
+        if entries:
+            yield entries
+        if not more:
+            return
+        since = changes[-1].change_id
+
+
+class Subscription(object):
+    """Bounded queue of the events for one stream"""
+
+    def __init__(self, category_ids, last_seq, maxsize):
+        self.category_ids = category_ids
+        self.last_seq = last_seq
+        self.queue = queue.Queue(maxsize)
+        # Set when events were dropped, the stream then reads the log
+        self.overflowed = False
+
+    def wants(self, entry):
+        return (self.category_ids is None or
+                entry['category_id'] in self.category_ids)
+
+
+class EventHub(object):
+    """Fans new changes out to the event streams of this process.
+
+    One thread polls the change log for all streams, so writes of other
+    processes are seen too. Commits in this process wake it at once.
+    """
+
+    def __init__(self, max_subscribers, queue_size, poll_interval):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.last_seq = None
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def subscribe(self, category_ids, last_seq, latest_seq):
+        """Return a new Subscription, or None if there are too many.
+
+        latest_seq is the newest change when the stream starts; the
+        stream reads anything from last_seq up to there from the log.
+        """
+        subscription = Subscription(category_ids, last_seq, self.queue_size)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(subscription)
+            if self.last_seq is None:
+                self.last_seq = latest_seq
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='event-hub')
+                self._thread.daemon = True
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def notify(self):
+        self._wake.set()
+
+    def publish(self, entries):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            for entry in entries:
+                if not subscription.wants(entry):
+                    continue
+                try:
+                    subscription.queue.put_nowait(entry)
+                except queue.Full:
+                    subscription.overflowed = True
+                    break
+
+    def poll(self):
+        for entries in read_changes(self.last_seq):
+            self.last_seq = entries[-1]['seq']
+            self.publish(entries)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            with self._lock:
+                if not self._subscribers:
+                    # The next stream starts the hub at the latest change,
+                    # instead of at the backlog of the idle time
+                    self.last_seq = None
+                    continue
+            try:
+                self.poll()
+            except Exception:
+                log.error('Failed to read the change log', exc_info=True,
+                          extra=fields(last_seq=self.last_seq))
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers),
+                    'max_subscribers': self.max_subscribers,
+                    'last_seq': self.last_seq}
+
+
+event_hub = EventHub(app.config['EVENTS_MAX_SUBSCRIBERS'],
+                     app.config['EVENTS_QUEUE_SIZE'],
+                     app.config['EVENTS_POLL_INTERVAL'])
+
+
+@event.listens_for(AppSession, 'after_commit')
+def notifyEventHub(session):
+    if session.info.pop('changes_recorded', False):
+        event_hub.notify()
+
+
+@event.listens_for(AppSession, 'after_rollback')
+def forgetChanges(session):
+    session.info.pop('changes_recorded', None)
+
+
+def format_event(entry):
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (
+        entry['seq'], entry['entity'], json.dumps(entry))
+
+
+def event_stream(subscription):
+    """Server-Sent Events of a subscription, until the client goes away"""
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    try:
+        yield 'retry: 3000\n\n'
+        # Resume after Last-Event-ID, then whenever events were dropped
+        catch_up = True
+        while True:
+            if catch_up or subscription.overflowed:
+                subscription.overflowed = False
+                batches = read_changes(subscription.last_seq)
+                catch_up = False
+            else:
+                try:
+                    batches = [[subscription.queue.get(timeout=heartbeat)]]
+                except queue.Empty:
+                    # Keeps proxies from closing an idle connection
+                    yield ': keep-alive\n\n'
+                    continue
+            for entries in batches:
+                for entry in entries:
+                    if entry['seq'] <= subscription.last_seq:
+                        continue
+                    subscription.last_seq = entry['seq']
+                    if subscription.wants(entry):
+                        yield format_event(entry)
+    finally:
+        event_hub.unsubscribe(subscription)
@@ -0,0 +1,116 @@
+import os
+import re
+import threading
+import time
+
+import requests
+from oauth2client import clientsecrets, crypt
+from oauth2client.client import flow_from_clientsecrets
+
+from item_catalog_app import app
+from item_catalog_app import http_client
+
+
+class ClientSecretsCache(object):
+    """oauth2client cache of parsed client secrets files.
+
+    An entry is dropped as soon as the modification time of its file
+    changes, so an updated file is read again on the next login.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, filename, namespace=''):
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._data.get((namespace, filename))
+        if entry is None or entry[0] != mtime:
+            return None
+        return entry[1]
+
+    def set(self, filename, value, namespace=''):
+        mtime = os.stat(filename).st_mtime
+        with self._lock:
+            self._data[(namespace, filename)] = (mtime, value)
+
+
+secrets_cache = ClientSecretsCache()
+
+
+def client_id():
+    client_type, client_info = clientsecrets.loadfile(
+        app.config['CLIENT_SECRETS_FILE'], cache=secrets_cache)
+    return client_info['client_id']
+
+
+def make_flow():
+    """OAuth flow of the app, without reading the secrets file each time"""
+    return flow_from_clientsecrets(app.config['CLIENT_SECRETS_FILE'],
+                                   scope='', cache=secrets_cache)
+
+
+class CertificateCache(object):
+    """Google's ID token signing certificates, refreshed when they expire"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._certs = None
+        self._expires = 0
+
+    def get(self):
+        with self._lock:
+            if time.time() < self._expires:
+                if self._certs is None:
+                    raise requests.RequestException(
+                        'Google certificates unavailable, retrying later')
+                return self._certs
+            try:
+                response = http_client.get(app.config['GOOGLE_CERTS_URL'])
+                response.raise_for_status()
+                self._certs = response.json()
+                self._expires = time.time() + self.max_age(response)
+            except (ValueError, requests.RequestException):
+                # Keep using the previous certificates, and let logins go
+                # on without waiting for Google until the next try
+                self._expires = time.time() + app.config['GOOGLE_CERTS_RETRY']
+                if self._certs is None:
+                    raise
+            return self._certs
+
+    @staticmethod
+    def max_age(response):
+        match = re.search(r'max-age=(\d+)',
+                          response.headers.get('Cache-Control', ''))
+        if match:
+            return int(match.group(1))
+        return app.config['GOOGLE_CERTS_MAX_AGE']
+
+
+certificate_cache = CertificateCache()
+
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+
+def verify_id_token(id_token):
+    """Return the claims of an ID token issued by Google for this app.
+
+    Returns None if the token cannot be verified locally, in which case
+    the caller falls back to asking Google.
+    """
+    if not id_token:
+        return None
+    try:
+        certs = certificate_cache.get()
+        claims = crypt.verify_signed_jwt_with_certs(
+            id_token, certs, client_id())
+    except (crypt.AppIdentityError, TypeError, ValueError,
+            requests.RequestException):
+        return None
+    if claims.get('iss') not in GOOGLE_ISSUERS:
+        return None
+    return claims
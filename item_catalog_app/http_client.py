@@ -0,0 +1,75 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from item_catalog_app import app
+from item_catalog_app.metrics import add_timing
+
+
+def make_session(config):
+    """Keep-alive session with a bounded connection pool per host"""
+    new_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=config['OAUTH_HTTP_POOL_SIZE'],
+                          pool_maxsize=config['OAUTH_HTTP_POOL_SIZE'],
+                          max_retries=0)
+    new_session.mount('https://', adapter)
+    new_session.mount('http://', adapter)
+    return new_session
+
+
+# Shared by all requests of this process, so TLS connections are reused
+http_session = make_session(app.config)
+
+# Threads for outbound calls that can run side by side
+http_executor = ThreadPoolExecutor(
+    max_workers=app.config['OAUTH_HTTP_POOL_SIZE'])
+
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', app.config['OAUTH_HTTP_TIMEOUT'])
+    start = time.time()
+    try:
+        return http_session.get(url, **kwargs)
+    finally:
+        # Calls from the executor threads are timed by their caller
+        add_timing('http', time.time() - start, count=1)
+
+
+def get_json_concurrently(*requests_args):
+    """Issue GET requests in parallel, each given as (url, params).
+
+    Returns the decoded JSON bodies in the same order.
+    """
+    start = time.time()
+    futures = [http_executor.submit(get, url, params=params)
+               for url, params in requests_args]
+    try:
+        return [future.result().json() for future in futures]
+    finally:
+        add_timing('http', time.time() - start, count=len(futures))
+
+
+class HttpResponse(dict):
+    """httplib2 style response: a dict of headers with a status"""
+
+    def __init__(self, response):
+        dict.__init__(self, dict((k.lower(), v)
+                                 for k, v in response.headers.items()))
+        self.status = response.status_code
+        self['status'] = str(response.status_code)
+
+
+class Http(object):
+    """httplib2.Http replacement for oauth2client, using the shared pool"""
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        start = time.time()
+        try:
+            response = http_session.request(
+                method, uri, data=body, headers=headers,
+                timeout=app.config['OAUTH_HTTP_TIMEOUT'])
+        finally:
+            add_timing('http', time.time() - start, count=1)
+        return HttpResponse(response), response.content
@@ -0,0 +1,141 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import re
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+from item_catalog_app import app
+
+
+# Parts of the names of logged fields whose values are never written out
+SENSITIVE_FIELDS = ('password', 'token', 'secret', 'authorization')
+# Whole names of such fields, too short or common to match inside other
+# names such as status_code
+SENSITIVE_NAMES = ('code', 'auth_code', 'oauth_code', 'state')
+REDACTED = '[redacted]'
+# Credentials in text, such as the query string of a URL in an exception
+SENSITIVE_TEXT = re.compile(
+    r'(\w*(?:%s)\w*=|(?<!\w)(?:%s)=)[^&\s\'"]+' % (
+        '|'.join(SENSITIVE_FIELDS), '|'.join(SENSITIVE_NAMES)), re.I)
+
+
+def fields(**kwargs):
+    """Structured fields for a log call, as in log.info(msg, extra=fields())"""
+    return {'fields': kwargs}
+
+
+def sensitive(key):
+    key = key.lower()
+    return (key in SENSITIVE_NAMES or
+            any(part in key for part in SENSITIVE_FIELDS))
+
+
+def redact(values):
+    return dict((key, REDACTED if sensitive(key) else value)
+                for key, value in values.items())
+
+
+def redact_text(text):
+    return SENSITIVE_TEXT.sub(r'\1' + REDACTED, text)
+
+
+class RequestIdFilter(logging.Filter):
+    """Tag each record with the id of the request that logged it"""
+
+    def filter(self, record):
+        record.request_id = (g.get('request_id')
+                             if has_request_context() else None)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with the redacted fields of the record"""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': redact_text(record.getMessage())}
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        entry.update(redact(getattr(record, 'fields', {})))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = redact_text(record.exc_text)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records rather than block a full queue"""
+
+    def __init__(self, log_queue):
+        QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Keep the traceback apart from the message, for the JSON formatter
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(config):
+    """Send the app's log records through a queue to a writer thread.
+
+    Request threads only put records on the queue, the writing to stderr
+    (the Apache error log under mod_wsgi) happens in the listener thread.
+    Returns the started listener.
+    """
+    log_queue = queue.Queue(maxsize=config['LOG_QUEUE_SIZE'])
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JSONFormatter())
+    listener = QueueListener(log_queue, stream_handler)
+
+    # Same logger as app.logger, so Flask adds no handler of its own
+    logger = logging.getLogger(app.name)
+    logger.setLevel(config['LOG_LEVEL'].upper())
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = configure_logging(app.config)
+log = logging.getLogger(app.name)
+
+
+# Use the caller's request id when a proxy sent one
+@app.before_request
+def assignRequestId():
+    g.request_id = (request.headers.get('X-Request-ID', '')[:64] or
+                    uuid.uuid4().hex)
+
+
+@app.after_request
+def sendRequestId(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
@@ -0,0 +1,233 @@
+import threading
+import time
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from item_catalog_app import app
+from item_catalog_app.database import pool_metrics
+
+
+# Upper bounds of the histogram buckets, in seconds and in statements
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"'))
+        for name, value in zip(names, values))
+
+
+class Counter(object):
+    """Prometheus counter with a fixed set of label names"""
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = (
+                self._values.get(label_values, 0) + amount)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram(Counter):
+    """Prometheus histogram with cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=TIME_BUCKETS):
+        Counter.__init__(self, name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, label_values, value):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # A count per bucket, then the number and sum of all values
+                counts = self._values[label_values] = (
+                    [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        names = self.labels + ('le',)
+        for label_values, counts in values:
+            bounds = self.buckets + ('+Inf',)
+            for bound, count in zip(bounds, counts[:-2] + [counts[-2]]):
+                yield (self.name + '_bucket',
+                       format_labels(names, label_values + (bound,)), count)
+            yield (self.name + '_sum',
+                   format_labels(self.labels, label_values), counts[-1])
+            yield (self.name + '_count',
+                   format_labels(self.labels, label_values), counts[-2])
+
+
+class Reading(Counter):
+    """Value read from a function when the metrics are shown"""
+
+    def __init__(self, name, description, read, kind='gauge'):
+        Counter.__init__(self, name, description)
+        self.read = read
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, '', self.read()
+
+
+REQUEST_LABELS = ('endpoint', 'method')
+
+requests_total = Counter(
+    'catalog_requests_total', 'Requests answered',
+    REQUEST_LABELS + ('status',))
+request_seconds = Histogram(
+    'catalog_request_seconds', 'Time to answer a request', REQUEST_LABELS)
+sql_statements = Histogram(
+    'catalog_request_sql_statements', 'SQL statements executed per request',
+    REQUEST_LABELS, buckets=COUNT_BUCKETS)
+sql_seconds = Histogram(
+    'catalog_request_sql_seconds', 'Time spent in SQL per request',
+    REQUEST_LABELS)
+template_seconds = Histogram(
+    'catalog_request_template_seconds', 'Time spent rendering templates '
+    'per request', REQUEST_LABELS)
+http_seconds = Histogram(
+    'catalog_request_http_seconds', 'Time spent waiting on outbound HTTP '
+    'calls per request', REQUEST_LABELS)
+
+
+def pool_reading(name):
+    return lambda: pool_metrics.snapshot()[name]
+
+
+METRICS = [
+    requests_total, request_seconds, sql_statements, sql_seconds,
+    template_seconds, http_seconds,
+    Reading('catalog_db_pool_checkouts_total',
+            'Database connection checkouts', pool_reading('checkouts'),
+            kind='counter'),
+    Reading('catalog_db_pool_connects_total', 'Database connections opened',
+            pool_reading('connects'), kind='counter'),
+    Reading('catalog_db_pool_timeouts_total', 'Waits for a database '
+            'connection that timed out', pool_reading('timeouts'),
+            kind='counter'),
+    Reading('catalog_db_pool_wait_seconds_total', 'Time spent waiting for '
+            'database connections', pool_reading('wait_total_seconds'),
+            kind='counter'),
+]
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.append('# HELP %s %s' % (metric.name, metric.description))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, labels, value))
+    return '\n'.join(lines) + '\n'
+
+
+#####################
+# Request recording #
+#####################
+
+def add_timing(name, seconds, count=0):
+    """Add time spent on name to the current request, if there is one"""
+    if not has_request_context() or 'timings' not in g:
+        return
+    timing = g.timings.setdefault(name, [0, 0.0])
+    timing[0] += count
+    timing[1] += seconds
+
+
+@app.before_request
+def startTimer():
+    g.request_start = time.time()
+    g.timings = {}
+
+
+@app.after_request
+def recordRequest(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.time() - g.request_start
+    labels = (request.url_rule.endpoint if request.url_rule else 'none',
+              request.method)
+    timings = g.timings
+    sql_count, sql_time = timings.get('sql', (0, 0.0))
+    requests_total.inc(labels + (response.status_code,))
+    request_seconds.observe(labels, elapsed)
+    sql_statements.observe(labels, sql_count)
+    sql_seconds.observe(labels, sql_time)
+    template_seconds.observe(labels, timings.get('template', (0, 0.0))[1])
+    http_seconds.observe(labels, timings.get('http', (0, 0.0))[1])
+    if app.config['SERVER_TIMING']:
+        parts = ['app;dur=%.1f' % (elapsed * 1000)]
+        for name in ('sql', 'template', 'http'):
+            if name in timings:
+                count, seconds = timings[name]
+                part = '%s;dur=%.1f' % (name, seconds * 1000)
+                if count:
+                    part += ';desc="count=%d"' % count
+                parts.append(part)
+        response.headers['Server-Timing'] = ', '.join(parts)
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def startStatement(conn, cursor, statement, parameters, context,
+                   executemany):
+    conn.info.setdefault('statement_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def endStatement(conn, cursor, statement, parameters, context,
+                 executemany):
+    started = conn.info['statement_start'].pop()
+    add_timing('sql', time.time() - started, count=1)
+
+
+@event.listens_for(Engine, 'handle_error')
+def failStatement(context):
+    if context.connection is not None:
+        started = context.connection.info.get('statement_start')
+        if started:
+            add_timing('sql', time.time() - started.pop(), count=1)
+
+
+class TimedTemplate(Template):
+    """Template that adds its render time to the current request"""
+
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            add_timing('template', time.time() - start, count=1)
+
+
+app.jinja_env.template_class = TimedTemplate
@@ -0,0 +1,295 @@
+import re
+
+import click
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import func, inspect, select, text
+
+from item_catalog_app import app
+from item_catalog_app.database import get_engine
+from item_catalog_app.models import Base, Change, Revision
+from item_catalog_app.models import create_search_index
+from item_catalog_app.models import parse_price
+
+
+# Applied migrations are recorded here, one row per version
+version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(250)),
+    Column('applied_at', DateTime, default=func.now()))
+
+# Ordered list of (version, description, function)
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a function as the migration to the given schema version"""
+    def decorator(f):
+        MIGRATIONS.append((version, description, f))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return f
+    return decorator
+
+
+def create_index(conn, name, table, columns):
+    """Create an index without locking the table against writes"""
+    if conn.dialect.name == 'postgresql':
+        statement = 'CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s)'
+    else:
+        statement = 'CREATE INDEX IF NOT EXISTS %s ON %s (%s)'
+    conn.execute(statement % (name, table, ', '.join(columns)))
+
+
+def drop_index(conn, name):
+    if conn.dialect.name == 'postgresql':
+        conn.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % name)
+    else:
+        conn.execute('DROP INDEX IF EXISTS %s' % name)
+
+
+def copy_text_prices(conn):
+    """Copy the old text prices that are still missing from
+    item_price_cents, returning the ids of items whose price does not
+    parse.
+
+    Rows are copied in small batches, so no long lock is held. The
+    item_price column is left in place for the rows that do not parse.
+    """
+    unparsed = []
+    last_id = 0
+    while True:
+        rows = conn.execute(text(
+            'SELECT item_id, item_price FROM item '
+            'WHERE item_id > :last_id AND item_price_cents IS NULL '
+            'AND item_price IS NOT NULL ORDER BY item_id LIMIT 1000'),
+            last_id=last_id).fetchall()
+        if not rows:
+            return unparsed
+        updates = []
+        for item_id, item_price in rows:
+            try:
+                cents = parse_price(item_price)
+            except ValueError:
+                unparsed.append(item_id)
+                continue
+            if cents is not None:
+                updates.append({'item_id': item_id, 'cents': cents})
+        if updates:
+            conn.execute(text(
+                'UPDATE item SET item_price_cents = :cents '
+                'WHERE item_id = :item_id'), updates)
+        last_id = rows[-1][0]
+
+
+def report_unparsed_prices(item_ids):
+    if item_ids:
+        click.echo('Prices of %d items could not be read and were left '
+                   'empty, see item_price of items: %s' % (
+                       len(item_ids), ', '.join(str(i) for i in item_ids)),
+                   err=True)
+
+
+##############
+# Migrations #
+##############
+
+@migration(1, 'Indexes for catalog filter and sort columns')
+def add_catalog_indexes(conn):
+    create_index(conn, 'ix_user_account_user_name',
+                 'user_account', ['user_name'])
+    create_index(conn, 'ix_category_category_name',
+                 'category', ['category_name'])
+    create_index(conn, 'ix_category_user_id_category_name',
+                 'category', ['user_id', 'category_name'])
+    create_index(conn, 'ix_item_item_date_item_id',
+                 'item', ['item_date', 'item_id'])
+    create_index(conn, 'ix_item_category_id_item_date',
+                 'item', ['category_id', 'item_date'])
+
+
+@migration(2, 'Revision counters for conditional GET requests')
+def add_revision_table(conn):
+    Revision.__table__.create(conn, checkfirst=True)
+
+
+@migration(3, 'Full text search index over items')
+def add_search_index(conn):
+    create_search_index(conn, concurrently=True)
+
+
+@migration(4, 'Numeric item prices in cents')
+def add_item_price_cents(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('item')]
+    if 'item_price_cents' not in columns:
+        conn.execute('ALTER TABLE item ADD COLUMN item_price_cents INTEGER')
+    if 'item_price' in columns:
+        # Migration 8 copies again and lists the prices still left out
+        copy_text_prices(conn)
+    create_index(conn, 'ix_item_item_price_cents_item_id',
+                 'item', ['item_price_cents', 'item_id'])
+    create_index(conn, 'ix_item_category_id_item_price_cents',
+                 'item', ['category_id', 'item_price_cents'])
+
+
+@migration(5, 'Change log for the incremental sync API')
+def add_change_table(conn):
+    Change.__table__.create(conn, checkfirst=True)
+
+
+@migration(6, 'Category of each change, for filtered event streams')
+def add_change_category(conn):
+    columns = [c['name'] for c in inspect(conn).get_columns('change')]
+    if 'category_id' not in columns:
+        conn.execute('ALTER TABLE change ADD COLUMN category_id INTEGER')
+
+
+@migration(7, 'Delete categories and items with their user or category '
+              'in the database')
+def add_cascading_deletes(conn):
+    for table, column, parent, parent_column in CASCADING_FOREIGN_KEYS:
+        keys = [k for k in inspect(conn).get_foreign_keys(table)
+                if k['constrained_columns'] == [column]]
+        if keys and (keys[0].get('options', {}).get(
+                'ondelete') or '').upper() == 'CASCADE':
+            continue
+        if conn.dialect.name == 'postgresql':
+            name = keys[0]['name'] if keys else '%s_%s_fkey' % (table, column)
+            # NOT VALID only locks the table briefly; checking the existing
+            # rows afterwards lets writes go on
+            conn.execute(
+                'ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s, '
+                'ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (%s) '
+                'ON DELETE CASCADE NOT VALID' % (
+                    table, name, name, column, parent, parent_column))
+            conn.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (
+                table, name))
+        elif conn.dialect.name == 'sqlite':
+            sql = conn.execute(text(
+                "SELECT sql FROM sqlite_master "
+                "WHERE type = 'table' AND name = :name"), name=table).scalar()
+            key = re.compile(
+                r'(FOREIGN KEY\s*\(\s*"?%s"?\s*\)\s*REFERENCES\s*"?%s"?'
+                r'\s*\(\s*"?%s"?\s*\))' % (column, parent, parent_column),
+                re.IGNORECASE)
+            if not key.search(sql):
+                raise RuntimeError('Cannot find the foreign key of %s.%s' % (
+                    table, column))
+            set_sqlite_table_sql(
+                conn, table, key.sub(r'\1 ON DELETE CASCADE', sql, 1))
+
+
+# Foreign keys whose rows are deleted with the row they refer to, as
+# (table, column, referred table, referred column)
+CASCADING_FOREIGN_KEYS = [
+    ('category', 'user_id', 'user_account', 'user_id'),
+    ('item', 'category_id', 'category', 'category_id'),
+]
+
+
+def set_sqlite_table_sql(conn, table, sql):
+    """Replace the CREATE TABLE statement SQLite keeps for a table.
+
+    SQLite cannot alter constraints, but documents this as the way to
+    change foreign keys, which do not affect how rows are stored, without
+    copying the table.
+    """
+    # The DB-API cursor, as SQLAlchemy would commit after the UPDATE
+    cursor = conn.connection.cursor()
+    version = cursor.execute('PRAGMA schema_version').fetchone()[0]
+    cursor.execute('BEGIN')
+    try:
+        cursor.execute('PRAGMA writable_schema=ON')
+        cursor.execute(
+            "UPDATE sqlite_master SET sql = ? "
+            "WHERE type = 'table' AND name = ?", (sql, table))
+        cursor.execute('PRAGMA schema_version=%d' % (version + 1))
+        cursor.execute('PRAGMA writable_schema=OFF')
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        cursor.close()
+    result = conn.execute('PRAGMA integrity_check').scalar()
+    if result != 'ok':
+        raise RuntimeError('Integrity check of %s failed: %s' % (
+            table, result))
+
+
+@migration(8, 'Prices with thousands separators in cents')
+def copy_grouped_prices(conn):
+    # Earlier versions of migration 4 could not read prices such as
+    # 1,000.00. The prices that still cannot be read are listed here.
+    columns = [c['name'] for c in inspect(conn).get_columns('item')]
+    if 'item_price' in columns:
+        report_unparsed_prices(copy_text_prices(conn))
+
+
+##########
+# Runner #
+##########
+
+def current_version(conn):
+    version_metadata.create_all(conn)
+    version = conn.execute(
+        select([func.max(schema_version.c.version)])).scalar()
+    return version or 0
+
+
+def upgrade(target=None):
+    """Apply all pending migrations up to target, returning those applied"""
+    applied = []
+    # Each migration runs in autocommit mode, as PostgreSQL does not allow
+    # concurrent index builds inside a transaction
+    with get_engine().connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        version = current_version(conn)
+        for number, description, f in MIGRATIONS:
+            if number <= version or (target is not None and number > target):
+                continue
+            f(conn)
+            conn.execute(schema_version.insert().values(
+                version=number, description=description))
+            applied.append((number, description))
+    return applied
+
+
+def init_db():
+    """Create the tables that are missing, returning whether it was new.
+
+    A new database gets the latest schema at once, so all migrations are
+    recorded as applied.
+    """
+    with get_engine().connect() as conn:
+        new = not inspect(conn).get_table_names()
+        Base.metadata.create_all(conn)
+        version = current_version(conn)
+        if new:
+            conn.execute(schema_version.insert(), [
+                {'version': number, 'description': description}
+                for number, description, f in MIGRATIONS
+                if number > version])
+    return new
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the database tables."""
+    if init_db():
+        click.echo('Created the database schema')
+    else:
+        click.echo('Database exists, created any missing tables. Run '
+                   '"flask migrate" to upgrade the existing ones.')
+
+
+@app.cli.command('migrate')
+@click.option('--target', type=int, default=None,
+              help='Schema version to upgrade to, defaults to the latest.')
+def migrate_command(target):
+    """Upgrade the database schema to the latest version."""
+    applied = upgrade(target)
+    for number, description in applied:
+        click.echo('Applied migration %s: %s' % (number, description))
+    if not applied:
+        click.echo('Database schema is up to date')
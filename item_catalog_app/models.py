@@ -1,10 +1,13 @@
 from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, func
+from sqlalchemy import Index, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import functions
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy import create_engine
 
 from passlib.apps import custom_app_context as pwd_context
 import random
+import re
 import string
 from itsdangerous import (TimedJSONWebSignatureSerializer as
                           Serializer,
@@ -17,14 +20,102 @@ from item_catalog_app import app
 Base = declarative_base()
 
 
-# Generate a secret key to create and verify tokens
-secret_key = ''.join(
+# SQLite stores CURRENT_TIMESTAMP without microseconds, which does not
+# compare equal to the datetimes SQLAlchemy binds, e.g. in page cursors
+@compiles(functions.now, 'sqlite')
+def sqlite_now(element, compiler, **kw):
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
+# Fallback key for tokens when no SECRET_KEY is configured. Such tokens
+# are only valid in the process that issued them.
+fallback_secret_key = ''.join(
     random.choice(string.ascii_uppercase + string.digits)
     for x in range(32))
 
+# Keeps auth tokens apart from other data signed with the same key
+token_salt = 'auth-token'
+
+
+def token_keys():
+    """Keys to verify auth tokens with, the signing key first"""
+    keys = [app.config.get('SECRET_KEY') or fallback_secret_key]
+    keys.extend(app.config.get('SECRET_KEY_PREVIOUS') or [])
+    return keys
+
+
+# Prices such as '12', '12.5', '$ 12.50', '12,50 EUR', '1,000.00' or
+# '1.000,00', optionally grouping thousands with one separator. A
+# currency symbol or three letter code may come before or after.
+PRICE_CURRENCY = r"(?:[$€£¥]|[A-Z]{3})"
+PRICE_PATTERN = re.compile(
+    r"^\s*(?:%s\s*)?(\d{1,3}(?:([,.' ])\d{3})(?:\2\d{3})*|\d{1,9})"
+    r"(?:([.,])(\d{1,2}))?\s*(?:%s)?\s*$" % (
+        PRICE_CURRENCY, PRICE_CURRENCY))
+
+
+def parse_price(value):
+    """Return a price as integer cents, None if empty.
+
+    Raises ValueError for text that is not a price.
+    """
+    if value is None:
+        return None
+    value = str(value)
+    if not value.strip():
+        return None
+    # Prices cannot be negative, and a sign is not read as a currency
+    if '-' in value or '+' in value:
+        raise ValueError('Invalid price: %s' % value)
+    match = PRICE_PATTERN.match(value)
+    # The decimal separator cannot also group thousands, as in '1.000.00'
+    if not match or (match.group(2) and match.group(2) == match.group(3)):
+        raise ValueError('Invalid price: %s' % value)
+    units = re.sub(r'\D', '', match.group(1))
+    if len(units) > 9:
+        raise ValueError('Invalid price: %s' % value)
+    cents = (match.group(4) or '0').ljust(2, '0')
+    return int(units) * 100 + int(cents)
+
+
+def format_price(cents):
+    if cents is None:
+        return None
+    return '%d.%02d' % divmod(cents, 100)
+
+
+class Revision(Base):
+    """Revision counter of one part of the catalog, such as 'categories'
+    or 'item:12', bumped on every write to it"""
+    __tablename__ = 'revision'
+
+    tag = Column(String(80), primary_key=True)
+    revision = Column(Integer, nullable=False, default=1)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class Change(Base):
+    """One insert, update or delete of a category or item, numbered in the
+    order the changes were committed"""
+    __tablename__ = 'change'
+    # Never reuse the number of a removed row on SQLite
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    change_id = Column(Integer, primary_key=True)
+    entity = Column(String(20), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    # Category of the item, or the category itself, for event filters
+    category_id = Column(Integer)
+    operation = Column(String(10), nullable=False)
+    changed_at = Column(DateTime, nullable=False, default=func.now())
+
 
 class UserAccount(Base):
     __tablename__ = 'user_account'
+    __table_args__ = (
+        # Basic auth looks users up by name on every API call
+        Index('ix_user_account_user_name', 'user_name'),
+    )
 
     user_id = Column(Integer, primary_key=True)
     user_name = Column(String(250), nullable=False)
@@ -32,14 +123,22 @@ class UserAccount(Base):
     user_picture = Column(String(250))
     password_hash = Column(String)
 
+    # Columns read by serialize_row, to list users without loading them
+    serialize_columns = ['user_id', 'user_name', 'user_email']
+
+    @staticmethod
+    def serialize_row(row):
+        """Serialize a user, or a row of its serialize_columns"""
+        return {
+            'user_id': row.user_id,
+            'user_name': row.user_name,
+            'user_email': row.user_email
+        }
+
     @property
     def serialize(self):
         """Return object data in easily serializeable format"""
-        return {
-            'user_id': self.user_id,
-            'user_name': self.user_name,
-            'user_email': self.user_email
-        }
+        return UserAccount.serialize_row(self)
 
     # Methods to generate and verify password_hash
     def hash_password(self, password):
@@ -50,69 +149,167 @@ class UserAccount(Base):
 
     # Method to generate auth tokens
     def generate_auth_token(self, expiration=600):
-        s = Serializer(secret_key, expires_in=expiration)
-        return s.dumps({"user_id": self.user_id})
+        return UserAccount.auth_token_for(self.user_id, expiration)
+
+    # Generate an auth token from a user id, without loading the user
+    @staticmethod
+    def auth_token_for(user_id, expiration=600):
+        s = Serializer(token_keys()[0], expires_in=expiration,
+                       salt=token_salt)
+        return s.dumps({"user_id": user_id})
 
     # Method to verify auth tokens
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(secret_key)
-        try:
-            data = s.loads(token)
-        except SignatureExpired:
-            # Valid token, but expired
-            return None
-        except BadSignature:
-            # Invalid token
-            return None
-        user_id = data['user_id']
-        return user_id
+        # Tokens signed with a previous key stay valid during key rotation
+        for key in token_keys():
+            s = Serializer(key, salt=token_salt)
+            try:
+                data = s.loads(token)
+            except SignatureExpired:
+                # Valid token, but expired
+                return None
+            except BadSignature:
+                # Invalid token, or signed with another key
+                continue
+            user_id = data['user_id']
+            return user_id
+        return None
 
 
 class Category(Base):
     __tablename__ = 'category'
+    __table_args__ = (
+        # Every page lists categories ordered by name
+        Index('ix_category_category_name', 'category_name'),
+        # Categories of one user, ordered by name
+        Index('ix_category_user_id_category_name', 'user_id', 'category_name'),
+    )
 
     category_id = Column(Integer, primary_key=True)
     category_name = Column(String(80), nullable=False)
-    user_id = Column(Integer, ForeignKey('user_account.user_id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('user_account.user_id',
+                                         ondelete='CASCADE'), nullable=False)
+    # The database deletes the categories of a deleted user, and their
+    # items, so they are never loaded just to be deleted
     user_account = relationship('UserAccount', backref=backref(
-        'categories', cascade='all, delete-orphan'))
+        'categories', cascade='all, delete-orphan', passive_deletes=True))
+
+    serialize_columns = ['category_id', 'category_name', 'user_id']
+
+    @staticmethod
+    def serialize_row(row):
+        """Serialize a category, or a row of its serialize_columns"""
+        return {
+            'category_id': row.category_id,
+            'category_name': row.category_name,
+            'user_id': row.user_id
+        }
 
     @property
     def serialize(self):
         """Return object data in easily serializeable format"""
-        return {
-            'category_id': self.category_id,
-            'category_name': self.category_name,
-            'user_id': self.user_id
-        }
+        return Category.serialize_row(self)
 
 
 class Item(Base):
     __tablename__ = 'item'
+    __table_args__ = (
+        # Latest items on the catalog page, newest first
+        Index('ix_item_item_date_item_id', 'item_date', 'item_id'),
+        # Items of one category, newest first
+        Index('ix_item_category_id_item_date', 'category_id', 'item_date'),
+        # Price range filters and ordering by price
+        Index('ix_item_item_price_cents_item_id',
+              'item_price_cents', 'item_id'),
+        Index('ix_item_category_id_item_price_cents',
+              'category_id', 'item_price_cents'),
+    )
 
     item_id = Column(Integer, primary_key=True)
     item_name = Column(String(80), nullable=False)
     item_description = Column(String)
-    item_price = Column(String(20))
+    item_price_cents = Column(Integer)
     item_date = Column(DateTime, default=func.now())
-    category_id = Column(Integer, ForeignKey('category.category_id'))
+    category_id = Column(Integer, ForeignKey('category.category_id',
+                                             ondelete='CASCADE'))
     category = relationship('Category', backref=backref(
-        'items', cascade='all, delete-orphan'))
+        'items', cascade='all, delete-orphan', passive_deletes=True))
 
     @property
-    def serialize(self):
-        """Return object data in easily serializeable format"""
+    def item_price(self):
+        """Price formatted with two decimals"""
+        return format_price(self.item_price_cents)
+
+    serialize_columns = ['item_name', 'item_description', 'item_id',
+                         'item_price_cents', 'item_date', 'category_id']
+    # Fields of serialize_row computed from another column
+    serialize_derived = {'item_price': 'item_price_cents'}
+
+    @staticmethod
+    def serialize_row(row):
+        """Serialize an item, or a row of its serialize_columns"""
         return {
-           'item_name': self.item_name,
-           'item_description': self.item_description,
-           'item_id': self.item_id,
-           'item_price': self.item_price,
-           'item_date': self.item_date,
-           'category_id': self.category_id
+           'item_name': row.item_name,
+           'item_description': row.item_description,
+           'item_id': row.item_id,
+           'item_price': format_price(row.item_price_cents),
+           'item_price_cents': row.item_price_cents,
+           'item_date': row.item_date,
+           'category_id': row.category_id
         }
 
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return Item.serialize_row(self)
+
+
+# Full text search index over item names and descriptions, queried in
+# search.py. PostgreSQL keeps the GIN index up to date on every write.
+SEARCH_INDEX_POSTGRESQL = (
+    "CREATE INDEX %s IF NOT EXISTS ix_item_search ON item USING gin "
+    "(to_tsvector('english', coalesce(item_name, '') || ' ' || "
+    "coalesce(item_description, '')))")
+
+# SQLite has an FTS5 table over the item table, kept in sync by triggers
+SEARCH_INDEX_SQLITE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS item_search USING fts5("
+    "item_name, item_description, content='item', content_rowid='item_id')",
+    "CREATE TRIGGER IF NOT EXISTS item_search_insert AFTER INSERT ON item "
+    "BEGIN "
+    "INSERT INTO item_search(rowid, item_name, item_description) "
+    "VALUES (new.item_id, new.item_name, new.item_description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS item_search_delete AFTER DELETE ON item "
+    "BEGIN "
+    "INSERT INTO item_search(item_search, rowid, item_name, "
+    "item_description) VALUES "
+    "('delete', old.item_id, old.item_name, old.item_description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS item_search_update AFTER UPDATE ON item "
+    "BEGIN "
+    "INSERT INTO item_search(item_search, rowid, item_name, "
+    "item_description) VALUES "
+    "('delete', old.item_id, old.item_name, old.item_description); "
+    "INSERT INTO item_search(rowid, item_name, item_description) "
+    "VALUES (new.item_id, new.item_name, new.item_description); "
+    "END",
+    "INSERT INTO item_search(item_search) VALUES ('rebuild')"
+]
+
+
+def create_search_index(conn, concurrently=False):
+    """Create the search index of the connected database if missing"""
+    if conn.dialect.name == 'postgresql':
+        conn.execute(SEARCH_INDEX_POSTGRESQL % (
+            'CONCURRENTLY' if concurrently else ''))
+    elif conn.dialect.name == 'sqlite':
+        for statement in SEARCH_INDEX_SQLITE:
+            conn.execute(statement)
 
-engine = create_engine(app.config['DATABASE_URL'])
 
-Base.metadata.create_all(engine)
+# New databases get the index together with the item table
+@event.listens_for(Item.__table__, 'after_create')
+def on_item_table_created(target, conn, **kw):
+    create_search_index(conn)
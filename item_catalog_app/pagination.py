@@ -0,0 +1,89 @@
+import base64
+import binascii
+import datetime
+import json
+
+from sqlalchemy import and_, or_
+
+from item_catalog_app import app
+
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last row on a page as an opaque string"""
+    values = [v.strftime(DATE_FORMAT) if isinstance(v, datetime.datetime)
+              else v for v in values]
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Decode a cursor into values matching the given sort columns.
+
+    Raises ValueError for cursors that were not made by encode_cursor.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(
+            base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid cursor')
+    decoded = []
+    for column, value in zip(columns, values):
+        try:
+            if column.type.python_type is datetime.datetime:
+                value = datetime.datetime.strptime(value, DATE_FORMAT)
+            elif column.type.python_type is int:
+                value = int(value)
+        except TypeError:
+            raise ValueError('Invalid cursor')
+        decoded.append(value)
+    return decoded
+
+
+def page_limit(value):
+    """Return the requested page size, bounded by API_MAX_PAGE_SIZE"""
+    if value is None or value == '':
+        return app.config['API_PAGE_SIZE']
+    limit = int(value)
+    if limit < 1:
+        raise ValueError('Limit must be positive')
+    return min(limit, app.config['API_MAX_PAGE_SIZE'])
+
+
+def keyset_page(query, columns, after, limit, descending=False):
+    """Return one page of rows ordered by columns, and the next cursor.
+
+    Rows are selected strictly after the decoded cursor values, so each
+    page costs one index range scan regardless of how deep it is.
+    """
+    if after is not None:
+        # (a, b) > (x, y) expanded as a > x OR (a = x AND b > y)
+        clauses = []
+        for i, column in enumerate(columns):
+            equal = [c == v for c, v in zip(columns[:i], after[:i])]
+            if descending:
+                equal.append(column < after[i])
+            else:
+                equal.append(column > after[i])
+            clauses.append(and_(*equal))
+        query = query.filter(or_(*clauses))
+    if descending:
+        query = query.order_by(*[c.desc() for c in columns])
+    else:
+        query = query.order_by(*columns)
+    # Fetch one extra row to learn whether there is a next page
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            [getattr(last, c.key) for c in columns])
+    return rows, next_cursor
@@ -0,0 +1,117 @@
+from functools import wraps
+
+from flask import Response, make_response, request
+from flask import session as login_session
+
+from item_catalog_app import app
+from item_catalog_app.cache import TTLCache
+from item_catalog_app.database import db_session, request_replica
+from item_catalog_app.revisions import request_revisions
+
+
+class LocalBackend(object):
+    """In process LRU of rendered pages, private to each worker process"""
+
+    def __init__(self, maxsize, ttl):
+        self.pages = TTLCache(maxsize, ttl)
+
+    def get(self, key):
+        return self.pages.get(key)
+
+    def set(self, key, body, ttl=None):
+        self.pages.set(key, body, ttl)
+
+    def stats(self):
+        return self.pages.stats()
+
+
+class RedisBackend(object):
+    """Pages in a Redis compatible server, shared by all worker processes"""
+
+    def __init__(self, url, ttl, prefix='item_catalog:'):
+        # Optional dependency, only needed when this backend is chosen
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        body = self.client.get(self.prefix + 'page:' + key)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def set(self, key, body, ttl=None):
+        self.client.setex(self.prefix + 'page:' + key, ttl or self.ttl, body)
+
+    def stats(self):
+        return {'ttl_seconds': self.ttl, 'hits': self.hits,
+                'misses': self.misses}
+
+
+class ResponseCache(object):
+    """Cache of pages rendered for anonymous visitors.
+
+    Each cached view declares the tags its content depends on. Writes bump
+    the revision of the tags they touch in the revision table, in their
+    own transaction, which changes the cache key of every page depending
+    on them in every process as soon as the write commits, so stale pages
+    are never served again.
+    """
+
+    def __init__(self, backend, session):
+        self.backend = backend
+        self.session = session
+
+    @staticmethod
+    def cacheable():
+        # Logged in users and pending flash messages change the page
+        return ('user_name' not in login_session and
+                '_flashes' not in login_session)
+
+    def cached(self, tags):
+        """Decorate a view, tags(**view_args) names what the page shows"""
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.backend is None or not self.cacheable():
+                    return f(*args, **kwargs)
+                page_tags = tags(**kwargs)
+                revisions = request_revisions(self.session, page_tags)[0]
+                key = '%s|%s' % (request.full_path,
+                                 ','.join(str(r) for r in revisions))
+                body = self.backend.get(key)
+                if body is not None:
+                    return Response(body, mimetype='text/html')
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and self.cacheable():
+                    # A replica may not have the latest writes yet
+                    ttl = (app.config['DATABASE_REPLICA_LAG']
+                           if request_replica() is not None else None)
+                    self.backend.set(key, response.get_data(), ttl)
+                return response
+            return wrapper
+        return decorator
+
+    def stats(self):
+        if self.backend is None:
+            return None
+        return self.backend.stats()
+
+
+def make_backend(config):
+    backend = config['RESPONSE_CACHE_BACKEND']
+    if backend == 'local':
+        return LocalBackend(config['RESPONSE_CACHE_SIZE'],
+                            config['RESPONSE_CACHE_TTL'])
+    elif backend == 'redis':
+        return RedisBackend(config['RESPONSE_CACHE_URL'],
+                            config['RESPONSE_CACHE_TTL'])
+    return None
+
+
+page_cache = ResponseCache(make_backend(app.config), db_session)
@@ -0,0 +1,103 @@
+import datetime
+import hashlib
+from functools import wraps
+
+from flask import g, make_response, request
+from sqlalchemy.exc import IntegrityError
+
+from item_catalog_app.models import Revision
+
+
+def bump_revisions(session, tags):
+    """Increment the revision of each tag, in the transaction of the write.
+
+    Call before committing the write, so the revisions change with the
+    rows they describe, and a failure rolls both back.
+    """
+    tags = sorted(set(tags))
+    now = datetime.datetime.utcnow()
+    # Writes the rows, and their change log entries, before the revisions
+    session.flush()
+    revisions = session.query(Revision).filter(Revision.tag.in_(tags))
+    updated = revisions.update(
+        {Revision.revision: Revision.revision + 1, Revision.updated_at: now},
+        synchronize_session=False)
+    if updated == len(tags):
+        return
+    existing = set(tag for tag, in session.query(
+        Revision.tag).filter(Revision.tag.in_(tags)))
+    missing = [tag for tag in tags if tag not in existing]
+    try:
+        with session.begin_nested():
+            session.bulk_insert_mappings(Revision, [
+                {'tag': tag, 'revision': 1, 'updated_at': now}
+                for tag in missing])
+    except IntegrityError:
+        # A concurrent writer inserted some of the new tags first
+        session.query(Revision).filter(Revision.tag.in_(missing)).update(
+            {Revision.revision: Revision.revision + 1,
+             Revision.updated_at: now},
+            synchronize_session=False)
+
+
+def current_revisions(session, tags):
+    """Return the revisions of tags, and when the latest of them changed"""
+    rows = dict((tag, (revision, updated_at))
+                for tag, revision, updated_at in session.query(
+                    Revision.tag, Revision.revision, Revision.updated_at
+                ).filter(Revision.tag.in_(tags)))
+    revisions = [rows.get(tag, (0, None))[0] for tag in tags]
+    dates = [updated_at for revision, updated_at in rows.values()]
+    return revisions, max(dates) if dates else None
+
+
+def request_revisions(session, tags):
+    """current_revisions, read once per request for the same tags"""
+    read = g.setdefault('revisions_read', {})
+    key = tuple(tags)
+    if key not in read:
+        read[key] = current_revisions(session, tags)
+    return read[key]
+
+
+def conditional(session, tags, when=None):
+    """Answer conditional GET requests for a view with 304 Not Modified.
+
+    tags(**view_args) names the parts of the catalog the response is made
+    of. Their revisions are checked before the view runs, so an unchanged
+    resource costs one small query. If when() returns False the view is
+    served without validators.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if when is not None and not when():
+                return f(*args, **kwargs)
+            view_tags = tags(**kwargs)
+            revisions, modified = request_revisions(session, view_tags)
+            etag = hashlib.sha1(('%s|%s|%s' % (
+                request.full_path, ','.join(view_tags),
+                ','.join(str(r) for r in revisions))).encode(
+                'utf-8')).hexdigest()
+            if modified is not None:
+                # HTTP dates have whole seconds
+                modified = modified.replace(microsecond=0)
+
+            not_modified = False
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            elif request.if_modified_since and modified is not None:
+                not_modified = modified <= request.if_modified_since
+
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            return response
+        return wrapper
+    return decorator
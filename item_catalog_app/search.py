@@ -0,0 +1,43 @@
+from sqlalchemy import Float, Integer, func, literal_column, text
+
+from item_catalog_app.models import Item
+
+
+# Must match the expression of the PostgreSQL search index in models
+SEARCH_CONFIG = literal_column("'english'")
+search_document = func.to_tsvector(
+    SEARCH_CONFIG,
+    func.coalesce(Item.item_name, '') + ' ' +
+    func.coalesce(Item.item_description, ''))
+
+
+def fts_query(terms):
+    # Quote every word, so user input is never read as FTS5 syntax
+    return ' '.join('"%s"' % word.replace('"', '""')
+                    for word in terms.split())
+
+
+def search_items(session, terms):
+    """Return a query of (Item, rank) matching terms, best match first"""
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        search_query = func.plainto_tsquery(SEARCH_CONFIG, terms)
+        rank = func.ts_rank(search_document, search_query)
+        return session.query(Item, rank.label('rank')).filter(
+            search_document.op('@@')(search_query)).order_by(
+            rank.desc(), Item.item_id.desc())
+    elif dialect == 'sqlite':
+        matches = text(
+            "SELECT rowid AS item_id, bm25(item_search) AS rank "
+            "FROM item_search WHERE item_search MATCH :terms").columns(
+            item_id=Integer, rank=Float).bindparams(
+            terms=fts_query(terms)).alias('matches')
+        # bm25 is lower for better matches
+        return session.query(Item, (-matches.c.rank).label('rank')).join(
+            matches, matches.c.item_id == Item.item_id).order_by(
+            matches.c.rank, Item.item_id.desc())
+    # Other databases fall back to an unranked substring match
+    pattern = '%%%s%%' % terms
+    return session.query(Item, literal_column('0').label('rank')).filter(
+        Item.item_name.ilike(pattern) |
+        Item.item_description.ilike(pattern)).order_by(Item.item_id.desc())
@@ -1,41 +1,50 @@
 from flask import Flask, render_template, request
 from flask import redirect, url_for, jsonify, flash, abort, g
-from sqlalchemy import create_engine, asc, desc
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import asc, desc, and_, or_, false, inspect, func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
 from item_catalog_app import app
-from item_catalog_app.models import Category, UserAccount, Item, Base
+from item_catalog_app.models import Category, UserAccount, Item, Change
+from item_catalog_app.models import parse_price, format_price
+from item_catalog_app.database import get_engine, db_session, pool_metrics
+from item_catalog_app.database import get_replicas, use_primary
+from item_catalog_app.pagination import decode_cursor, keyset_page, page_limit
+from item_catalog_app.cache import TTLCache
+from item_catalog_app.response_cache import page_cache
+from item_catalog_app.revisions import bump_revisions, conditional
+from item_catalog_app.search import search_items
+from item_catalog_app.changes import change_entries, changes_since
+from item_catalog_app.changes import record_changes
+from item_catalog_app.events import event_hub, event_stream
+from item_catalog_app import encoding, http_client, google_auth
+from item_catalog_app.logs import log, fields
+from item_catalog_app.metrics import render_metrics
 
-from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
-from flask import make_response
+from flask import make_response, Response, stream_with_context
+from flask import json as flask_json
 from flask import session as login_session
 from flask_httpauth import HTTPBasicAuth
-import httplib2
 import requests
+import hashlib
+import hmac
 import json
 import random
 import string
 import sys
 import os
+import time
+from types import SimpleNamespace
 
 
 auth = HTTPBasicAuth()
 
-engine = create_engine(app.config['DATABASE_URL'])
-Base.metadata.bind = engine
-Session = sessionmaker(bind=engine)
-session = Session()
+# Request scoped session, removed again in teardown_appcontext
+session = db_session
 
 
-# Load client_id from google oauth client file
-file_dir = os.path.dirname(os.path.abspath(__file__))
-parent_dir = os.path.dirname(file_dir)
-client_secrets_path = os.path.join(parent_dir, 'client_secrets.json')
-with open(client_secrets_path, 'r') as f:
-    CLIENT_ID = json.loads(f.read())['web']['client_id']
-
 # Load Flask session secret from file
 # with open('vagrant/item_catalog_project/session_secrets.json', 'r') as f:
 #     SESSION_SECRET = json.loads(f.read())['secret']
@@ -45,25 +54,63 @@ with open(client_secrets_path, 'r') as f:
 # Authorisation and Authentication #
 ####################################
 
+# Recently verified users, keyed by user id for tokens and by a digest of
+# the credentials for username / password
+credential_cache = TTLCache(app.config['AUTH_CACHE_SIZE'],
+                            app.config['AUTH_CACHE_TTL'])
+
+# Per process key, so cached digests are useless outside this worker
+credential_key = os.urandom(32)
+
+
+def credentialDigest(username, password):
+    message = ('%s:%s' % (username, password)).encode('utf-8')
+    return hmac.new(credential_key, message, hashlib.sha256).hexdigest()
+
+
+# What a cache hit is checked against: the user's current password hash
+def cachedUser(user):
+    return (user.user_id, user.password_hash)
+
+
+def findUser(user_id, user_name):
+    if user_id:
+        return session.query(UserAccount).filter_by(user_id=user_id).first()
+    return session.query(UserAccount).filter_by(user_name=user_name).first()
+
+
 # Verify token or username / password for protected routes
 @auth.verify_password
 def verify_password(username_or_token, password):
     # Check for token
-    print('username_or_token: ', username_or_token)
-    print('password: ', password)
-    print('Checking for token or password')
     user_id = UserAccount.verify_auth_token(username_or_token)
     if user_id:
-        print('Found user_id')
-        user = session.query(UserAccount).filter_by(user_id=user_id).one()
+        key = ('token', user_id)
     else:
-        print('Checking username and password')
-        user = session.query(UserAccount).filter_by(
-            user_name=username_or_token).first()
-        print('user: ', user)
-        if not user or not user.verify_password(password):
-            print('found no user')
-            return False
+        key = ('basic', username_or_token,
+               credentialDigest(username_or_token, password))
+    cached = credential_cache.get(key)
+    if cached is not None:
+        # The user row is shared by all processes, so a password changed
+        # by any of them, or a deleted user, ends the cached login
+        user = session.query(UserAccount).get(cached[0])
+        if user is not None and user.password_hash == cached[1]:
+            g.user = user
+            return True
+        credential_cache.delete(key)
+
+    user = findUser(user_id, username_or_token)
+    # A new user may not have reached the read replica yet
+    if user is None and use_primary():
+        user = findUser(user_id, username_or_token)
+    if not user or not (user_id or user.verify_password(password)):
+        # An unknown name may be a mistyped password or an old token
+        log.info('API login failed', extra=fields(
+            user_id=user.user_id if user else None))
+        return False
+    credential_cache.set(key, cachedUser(user))
+    log.debug('API login', extra=fields(
+        user_id=user.user_id, method='token' if user_id else 'password'))
     g.user = user
     return True
 
@@ -71,7 +118,6 @@ def verify_password(username_or_token, password):
 # Collect oauth user info and generate app token
 @app.route('/oauth/<provider>', methods=['POST'])
 def login(provider):
-    print('Inside login view!')
     # Exchange one-time client code for oauth access token
     if provider == 'google':
         # check for 'X-Requested-With' header to prevent CSRF attacks
@@ -89,46 +135,70 @@ def login(provider):
         auth_code = request.data
         # upgrade the authorization code into a credentials object
         try:
-            print('starting oauth flow')
-            oauth_flow = flow_from_clientsecrets(
-                client_secrets_path, scope='')
+            oauth_flow = google_auth.make_flow()
             oauth_flow.redirect_uri = 'postmessage'
-            credentials = oauth_flow.step2_exchange(auth_code)
-            print('finished oauth flow')
-        except FlowExchangeError:
-            print('inside FlowExchangeError')
+            credentials = oauth_flow.step2_exchange(
+                auth_code, http=http_client.Http())
+        except (FlowExchangeError, requests.RequestException):
+            log.warning('Failed to upgrade authorization code',
+                        exc_info=True, extra=fields(provider=provider))
             response = make_response(json.dumps(
                 'Failed to upgrade authorization code'), 401)
             response.headers['Content-type'] = 'application/json'
             return response
 
-        # Check that oauth access_token is valid
         access_token = credentials.access_token
-        print('access token received: %s' % access_token)
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-               % access_token)
-        h = httplib2.Http()
-        result = json.loads(h.request(url, 'GET')[1])
-        print('result: %s' % result)
-        if result.get('error') is not None:
-            response = make_response(json.dumps(result.get('error')), 500)
-            response.headers['Content-Type'] = 'application/json'
-
-        # verify the access token is used for the intended user
         g_id = credentials.id_token['sub']
-        if result['user_id'] != g_id:
-            response = make_response(
-                json.dumps("Token's user ID does not match given user ID."),
-                401)
-            response.headers['Content-type'] = 'application/json'
-            return response
 
-        # verify the access token is valid for this app
-        if result['issued_to'] != CLIENT_ID:
-            response = make_response(
-                json.dumps("Token's client ID does not match app's."), 401)
-            response.headers['Content-type'] = 'application/json'
-            return response
+        # A signed ID token for this app, verified with Google's cached
+        # certificates, proves the user and carries the user info
+        claims = google_auth.verify_id_token(
+            credentials.token_response.get('id_token'))
+        if (claims is not None and claims['sub'] == g_id and
+                claims.get('email')):
+            data = {'name': claims.get('name', claims['email']),
+                    'picture': claims.get('picture', ''),
+                    'email': claims['email']}
+        else:
+            # Check that oauth access_token is valid, and get the user info
+            # from the oauth provider at the same time
+            try:
+                result, data = http_client.get_json_concurrently(
+                    (app.config['OAUTH_TOKENINFO_URL'],
+                     {'access_token': access_token}),
+                    (app.config['OAUTH_USERINFO_URL'],
+                     {'access_token': access_token, 'alt': 'json'}))
+            except (requests.RequestException, ValueError):
+                log.warning('Failed to reach the OAuth provider',
+                            exc_info=True, extra=fields(provider=provider))
+                response = make_response(
+                    json.dumps('Failed to reach the OAuth provider'), 502)
+                response.headers['Content-Type'] = 'application/json'
+                return response
+            if result.get('error') is not None:
+                log.warning('OAuth access token rejected',
+                            extra=fields(provider=provider,
+                                         error=result.get('error')))
+                response = make_response(json.dumps(result.get('error')), 500)
+                response.headers['Content-Type'] = 'application/json'
+                return response
+
+            # verify the access token is used for the intended user
+            if result['user_id'] != g_id:
+                response = make_response(
+                    json.dumps(
+                        "Token's user ID does not match given user ID."),
+                    401)
+                response.headers['Content-type'] = 'application/json'
+                return response
+
+            # verify the access token is valid for this app
+            if result['issued_to'] != google_auth.client_id():
+                response = make_response(
+                    json.dumps("Token's client ID does not match app's."),
+                    401)
+                response.headers['Content-type'] = 'application/json'
+                return response
 
         # check to see if user is already logged in
         stored_access_token = login_session.get('access_token')
@@ -143,12 +213,6 @@ def login(provider):
         login_session['access_token'] = credentials.access_token
         login_session['g_id'] = g_id
 
-        # Get user info from oauth provider
-        userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-        params = {'access_token': credentials.access_token, 'alt': 'json'}
-        answer = requests.get(userinfo_url, params=params)
-        data = answer.json()
-
         login_session['user_name'] = data['name']
         login_session['user_picture'] = data['picture']
         login_session['user_email'] = data['email']
@@ -159,6 +223,10 @@ def login(provider):
         if not user_id:
             user_id = createUser(login_session)
         login_session['user_id'] = user_id
+        # A token kept from an account logged in before belongs to it
+        login_session.pop('api_token', None)
+        login_session.pop('api_token_user', None)
+        login_session.pop('api_token_expires', None)
 
         # Generate token and send back to client
         user = getUserInfo(user_id)
@@ -174,7 +242,8 @@ def login(provider):
         output += '-webkit-border-radius: 150px;-moz-border-radius: 150px;">'
         output += '<h2>redirecting...</h2>'
         flash("you are now logged in as %s" % login_session['user_name'])
-        print("Done logging in!")
+        log.info('User logged in',
+                 extra=fields(provider=provider, user_id=user_id))
         return output
 
     else:
@@ -193,6 +262,9 @@ def oauthDisconnect():
         del login_session['user_picture']
         del login_session['user_id']
         del login_session['provider']
+        login_session.pop('api_token', None)
+        login_session.pop('api_token_user', None)
+        login_session.pop('api_token_expires', None)
         flash('You have successfully logged out')
         return redirect(url_for('catalog'))
 
@@ -202,23 +274,26 @@ def gdisconnect():
     # check if there is a user to disconnect
     access_token = login_session.get('access_token')
     if access_token is None:
-        print('Access token is None')
         response = make_response(json.dumps('Current user not connected'), 401)
         response.headers['Content-type'] = 'application/json'
         return response
-    print('In gdisconnect access token is %s' % access_token)
-    print('User name is: ')
-    print(login_session['user_name'])
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s'\
-        % login_session['access_token']
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
-
-    if result['status'] == '200':
+    try:
+        result = http_client.get(app.config['OAUTH_REVOKE_URL'],
+                                 params={'token': access_token})
+        status = result.status_code
+    except requests.RequestException:
+        log.warning('Failed to reach the OAuth provider', exc_info=True,
+                    extra=fields(provider='google'))
+        status = None
+
+    if status == 200:
         response = make_response(json.dumps('Successfully disconnected'), 200)
         response.headers['Content-type'] = 'application/json'
         return response
     else:
+        log.warning('Failed to revoke token',
+                    extra=fields(user_id=login_session.get('user_id'),
+                                 status=status))
         response = make_response(json.dumps('Failed to revoke token'), 400)
         response.headers['Content-type'] = 'application/json'
         return response
@@ -241,6 +316,74 @@ def getUserInfo(user_id):
     return user
 
 
+# Lifetime of API tokens shown to logged in users, in seconds
+SESSION_TOKEN_LIFETIME = 600
+# Issue a new token once the stored one has less time than this left
+SESSION_TOKEN_RENEW_BEFORE = 120
+
+
+# API token for the logged in user, kept in the Flask session
+def getSessionToken():
+    user_id = login_session['user_id']
+    token = login_session.get('api_token')
+    expires = login_session.get('api_token_expires', 0)
+    if (token is None or login_session.get('api_token_user') != user_id or
+            expires - time.time() < SESSION_TOKEN_RENEW_BEFORE):
+        token = UserAccount.auth_token_for(
+            user_id, SESSION_TOKEN_LIFETIME).decode('ascii')
+        login_session['api_token'] = token
+        login_session['api_token_user'] = user_id
+        login_session['api_token_expires'] = (
+            time.time() + SESSION_TOKEN_LIFETIME)
+    return token
+
+
+# Tags of the catalog parts each page or API response is made of, used by
+# the response cache and for conditional GET requests
+def catalogPageTags(**kwargs):
+    return ['categories', 'items']
+
+
+def categoryPageTags(category_id, **kwargs):
+    return ['categories', 'category:%s' % category_id]
+
+
+def itemPageTags(item_id, **kwargs):
+    return ['categories', 'item:%s' % item_id]
+
+
+def categoryListTags(**kwargs):
+    return ['categories']
+
+
+def itemListTags(**kwargs):
+    # Deleting a category deletes its items as well
+    return ['categories', 'items']
+
+
+# Call after categories were created, edited or deleted, before the
+# commit, so their revisions change in the same transaction
+def categoriesChanged(category_ids):
+    tagsChanged(['categories'] +
+                ['category:%s' % c for c in category_ids])
+
+
+# Call after items were created, edited or deleted, before the commit
+def itemsChanged(item_ids, category_ids):
+    tagsChanged(['items'] +
+                ['item:%s' % i for i in item_ids] +
+                ['category:%s' % c for c in category_ids])
+
+
+def tagsChanged(tags):
+    bump_revisions(session, tags)
+
+
+# Only anonymous pages are the same for everyone
+def isAnonymousPage():
+    return page_cache.cacheable()
+
+
 def getUserID(email):
     try:
         user = session.query(UserAccount).filter_by(user_email=email).one()
@@ -260,28 +403,30 @@ def showLogin():
     state = ''.join(random.choice(string.ascii_uppercase + string.digits)
                     for x in range(32))
     login_session['state'] = state
-    print('state is: %s' % state)
     return render_template('showLogin.html',
                            STATE=state,
-                           CLIENT_ID = CLIENT_ID)
+                           CLIENT_ID = google_auth.client_id())
 
 
 @app.route('/')
 @app.route('/catalog')
+@conditional(session, catalogPageTags, when=isAnonymousPage)
+@page_cache.cached(catalogPageTags)
 def catalog():
-    categories = session.query(Category).order_by(Category.category_name).all()
-    items = session.query(Item).order_by(desc(Item.item_date)).limit(10)
+    categories = session.query(Category).options(
+        joinedload(Category.user_account)).order_by(
+        Category.category_name).all()
+    items = session.query(Item).options(
+        joinedload(Item.category).joinedload(Category.user_account)).order_by(
+        desc(Item.item_date)).limit(10).all()
     token = "None"
 
     # Check for logged in user and creator of categories
     loggedIn = False
     if 'user_name' in login_session:
         loggedIn = True
-        # Generate token for API
-        user_id = getUserID(login_session['user_email'])
-        user = getUserInfo(user_id)
-        token = user.generate_auth_token(600)
-        token = token.decode('ascii')
+        # Reuse the API token until it is close to expiry
+        token = getSessionToken()
 
     return render_template(
         'catalog.html', loggedIn=loggedIn, categories=categories, items=items, token=token)
@@ -297,6 +442,8 @@ def addCategory():
             newCategory = Category(category_name=request.form['category_name'],
                                    user_id=login_session['user_id'])
             session.add(newCategory)
+            session.flush()
+            categoriesChanged([newCategory.category_id])
             session.commit()
             flash('New Category created!')
             return redirect(url_for('showCategory',
@@ -332,6 +479,7 @@ def editCategory(category_name, category_id):
             ('category_name') and request.method == 'POST'):
         category.category_name = request.form['category_name']
         session.add(category)
+        categoriesChanged([category_id])
         session.commit()
         flash('Category edited')
         return redirect(url_for('showCategory',
@@ -362,6 +510,7 @@ def deleteCategory(category_name, category_id):
 
     if creator and request.method == 'POST':
         session.delete(category)
+        categoriesChanged([category_id])
         session.commit()
         flash('Category and all its items deleted!')
         return redirect(url_for('catalog'))
@@ -370,13 +519,30 @@ def deleteCategory(category_name, category_id):
 
 
 @app.route('/catalog/<category_name>/<int:category_id>')
+@conditional(session, categoryPageTags, when=isAnonymousPage)
+@page_cache.cached(categoryPageTags)
 def showCategory(category_name, category_id):
-    category = session.query(Category).filter_by(
-        category_id=category_id).one()
-    categories = session.query(Category).order_by(
+    categories = session.query(Category).options(
+        joinedload(Category.user_account)).order_by(
         Category.category_name).all()
-    items = session.query(Item).filter_by(
-        category_id=category.category_id).all()
+    # The current category is among all categories, no extra query needed
+    category = next((c for c in categories if c.category_id == category_id),
+                    None)
+    if category is None:
+        raise NoResultFound()
+    # Optional price range and price ordering of the items
+    try:
+        min_price = parse_price(request.args.get('min_price'))
+        max_price = parse_price(request.args.get('max_price'))
+    except ValueError:
+        min_price = max_price = None
+    sort = request.args.get('sort')
+    items = priceFilter(session.query(Item).filter_by(
+        category_id=category.category_id), min_price, max_price)
+    if sort in ('price', '-price'):
+        items = items.order_by(*[c.desc() if sort == '-price' else c
+                                 for c in ITEM_PRICE_ORDER])
+    items = items.all()
 
     # Check for logged in user and creator of categories
     loggedIn = False
@@ -391,7 +557,10 @@ def showCategory(category_name, category_id):
                            creator=creator,
                            category=category,
                            categories=categories,
-                           items=items)
+                           items=items,
+                           min_price=format_price(min_price),
+                           max_price=format_price(max_price),
+                           sort=sort)
 
 
 @app.route('/catalog/<category_name>/<int:category_id>/item/new',
@@ -418,12 +587,21 @@ def addItem(category_name, category_id):
                         category_id=category.category_id)
 
     elif creator and request.method == 'POST':
+        try:
+            price_cents = parse_price(request.form['item_price'])
+        except ValueError:
+            flash('The price must be a number, such as 12.50')
+            return redirect(url_for('addItem',
+                                    category_name=category.category_name,
+                                    category_id=category.category_id))
         if request.form['item_name']:
             newItem = Item(item_name=request.form['item_name'],
                            item_description=request.form['item_description'],
-                           item_price=request.form['item_price'],
+                           item_price_cents=price_cents,
                            category_id=category_id)
             session.add(newItem)
+            session.flush()
+            itemsChanged([newItem.item_id], [category_id])
             session.commit()
             flash('New Item added!')
             return redirect(url_for('showItem',
@@ -439,11 +617,43 @@ def addItem(category_name, category_id):
                                categories=categories)
 
 
+# Results shown per page of the search page
+SEARCH_PAGE_SIZE = 20
+
+
+@app.route('/catalog/search')
+def searchItems():
+    terms = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    category_id = request.args.get('category_id', type=int)
+    categories = session.query(Category).order_by(
+        Category.category_name).all()
+    results = []
+    has_next = False
+    if terms:
+        results = searchQuery(terms, category_id).options(
+            joinedload(Item.category)).limit(SEARCH_PAGE_SIZE + 1).offset(
+            (page - 1) * SEARCH_PAGE_SIZE).all()
+        has_next = len(results) > SEARCH_PAGE_SIZE
+        results = results[:SEARCH_PAGE_SIZE]
+
+    return render_template('search.html',
+                           terms=terms,
+                           page=page,
+                           has_next=has_next,
+                           category_id=category_id,
+                           categories=categories,
+                           items=[item for item, rank in results])
+
+
 @app.route('/catalog/<category_name>/<item_name>/<int:item_id>')
+@conditional(session, itemPageTags, when=isAnonymousPage)
+@page_cache.cached(itemPageTags)
 def showItem(category_name, item_name, item_id):
-    item = session.query(Item).filter_by(item_id=item_id).one()
-    category = session.query(Category).filter_by(
-        category_id=item.category_id).one()
+    item = session.query(Item).options(
+        joinedload(Item.category).joinedload(Category.user_account)).filter_by(
+        item_id=item_id).one()
+    category = item.category
     # Check for logged in user and creator of categories
     loggedIn = False
     creator = False
@@ -465,11 +675,11 @@ def editItem(category_name, item_name, item_id):
     if 'user_name' not in login_session:
         flash('You need to log in to edit an item')
         return redirect(url_for('catalog'))
-    item = session.query(Item).filter_by(item_id=item_id).one()
-    category = session.query(Category).filter_by(
-        category_id=item.category_id).one()
+    item = session.query(Item).options(
+        joinedload(Item.category)).filter_by(item_id=item_id).one()
+    category = item.category
     categories = session.query(Category).filter_by(
-        user_id=category.user_account.user_id).order_by(
+        user_id=category.user_id).order_by(
         Category.category_name).all()
     # Check for creator of category
     creator = False
@@ -483,15 +693,25 @@ def editItem(category_name, item_name, item_id):
                         category_id=category.category_id)
 
     elif creator and request.method == 'POST':
+        old_category_id = item.category_id
         if request.form['item_name']:
             item.item_name = request.form['item_name']
         if request.form['item_description']:
             item.item_description = request.form['item_description']
         if request.form['item_price']:
-            item.item_price = request.form['item_price']
+            try:
+                item.item_price_cents = parse_price(
+                    request.form['item_price'])
+            except ValueError:
+                flash('The price must be a number, such as 12.50')
+                return redirect(url_for('editItem',
+                                        category_name=category.category_name,
+                                        item_name=item.item_name,
+                                        item_id=item.item_id))
         if request.form['category_id']:
             item.category_id = request.form['category_id']
         session.add(item)
+        itemsChanged([item_id], [old_category_id, item.category_id])
         session.commit()
         editedCategory = session.query(Category).filter_by(
             category_id=item.category_id).one()
@@ -514,9 +734,9 @@ def deleteItem(category_name, item_name, item_id):
     if 'user_name' not in login_session:
         flash('You need to log in to delete an item')
         return redirect(url_for('catalog'))
-    item = session.query(Item).filter_by(item_id=item_id).one()
-    category = session.query(Category).filter_by(
-        category_id=item.category_id).one()
+    item = session.query(Item).options(
+        joinedload(Item.category)).filter_by(item_id=item_id).one()
+    category = item.category
     # Check for creator of category
     creator = False
     if login_session.get('user_id') == category.user_id:
@@ -530,6 +750,7 @@ def deleteItem(category_name, item_name, item_id):
 
     elif creator and request.method == 'POST':
         session.delete(item)
+        itemsChanged([item_id], [category.category_id])
         session.commit()
         flash('Item deleted')
         return redirect(url_for('showCategory',
@@ -573,10 +794,40 @@ def get_auth_token():
     return jsonify({"token": token.decode('ascii')})
 
 
-# Get all categories
+# Sort keys for the paginated list endpoints
+CATEGORY_ORDER = [Category.category_id]
+ITEM_ORDER = [Item.item_date, Item.item_id]
+ITEM_PRICE_ORDER = [Item.item_price_cents, Item.item_id]
+# Sort parameter of the item list: sort keys and whether descending
+ITEM_SORTS = {
+    'date': (ITEM_ORDER, True),
+    'price': (ITEM_PRICE_ORDER, False),
+    '-price': (ITEM_PRICE_ORDER, True)
+}
+USER_ORDER = [UserAccount.user_id]
+
+
+def serializeColumns(model):
+    return [getattr(model, name) for name in model.serialize_columns]
+
+
+# List endpoints select these columns as plain rows, without building
+# and tracking an instance per row
+CATEGORY_COLUMNS = serializeColumns(Category)
+ITEM_COLUMNS = serializeColumns(Item)
+USER_COLUMNS = serializeColumns(UserAccount)
+
+
+# Get all categories, one page at a time
 @app.route('/api/catalog/categories')
+@conditional(session, categoryListTags)
 def categories_handler():
-    return getAllCategoriesAPI()
+    try:
+        limit = page_limit(request.args.get('limit'))
+        after = decode_cursor(request.args.get('after'), CATEGORY_ORDER)
+    except ValueError:
+        return jsonify({"error": "Invalid limit or after parameter"})
+    return getAllCategoriesAPI(limit, after)
 
 
 # Operate on a specific category
@@ -584,11 +835,20 @@ def categories_handler():
 @auth.login_required
 def category_handler():
     try:
-        category_id = request.json.get('id')
-        category_name = request.json.get('name')
+        params = requestParams()
+        category_id = params.get('id')
+        category_name = params.get('name')
+        try:
+            category_ids, field_names = multiGetParams(Category, params)
+        except ValueError:
+            return jsonify({"error": "Invalid ids or fields parameter"})
+
+        if category_ids and request.method == 'GET':
+            return getManyAPI(Category, 'categories', category_ids,
+                              field_names)
 
-        if category_id and request.method == 'GET':
-            return getCategoryAPI(category_id)
+        elif category_id and request.method == 'GET':
+            return getCategoryAPI(category_id, field_names)
 
         elif category_name and request.method == 'POST':
             return addCategoryAPI(category_name)
@@ -607,31 +867,104 @@ def category_handler():
         return jsonify({"error": "Cannot access Category ID %s" % category_id})
 
 
-# Get all items
+# Get all items, newest first, one page at a time
 @app.route('/api/catalog/items')
+@conditional(session, itemListTags)
 def items_handler():
     try:
-        items = session.query(Item).all()
-        return getAllItemsAPI(items)
+        limit = page_limit(request.args.get('limit'))
+        sort = request.args.get('sort', 'date')
+        if sort not in ITEM_SORTS:
+            raise ValueError('Unknown sort order')
+        after = decode_cursor(request.args.get('after'), ITEM_SORTS[sort][0])
+        category_id = request.args.get('category_id', type=int)
+        min_price = parse_price(request.args.get('min_price'))
+        max_price = parse_price(request.args.get('max_price'))
+    except ValueError:
+        return jsonify({
+            "error": "Invalid limit, after, sort or price parameter"})
+    try:
+        return getAllItemsAPI(limit, after, category_id,
+                              min_price, max_price, sort)
 
     except NoResultFound:
         return jsonify({"error": "Cannot retrive Items"})
 
 
+# Search items by name and description, best match first
+@app.route('/api/catalog/search')
+def search_handler():
+    terms = request.args.get('q', '').strip()
+    try:
+        limit = page_limit(request.args.get('limit'))
+        page = int(request.args.get('page', 1))
+        category_id = request.args.get('category_id', type=int)
+    except ValueError:
+        return jsonify({"error": "Invalid limit or page parameter"})
+    if not terms or page < 1:
+        return jsonify({"error": "Missing search terms in parameter q"})
+    return searchItemsAPI(terms, limit, page, category_id)
+
+
+# Inserts, updates and deletes of categories and items after a change
+# number, oldest first, one page at a time
+@app.route('/api/catalog/changes')
+def changes_handler():
+    try:
+        limit = page_limit(request.args.get('limit'))
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid limit or since parameter"})
+    return getChangesAPI(since, limit)
+
+
+# Server-Sent Events of the changes as they are committed, optionally only
+# for some categories, resuming after the Last-Event-ID header
+@app.route('/api/catalog/events')
+def events_handler():
+    try:
+        since = request.headers.get('Last-Event-ID',
+                                    request.args.get('since'))
+        since = int(since) if since is not None else None
+        category_ids = request.args.get('category_id')
+        if category_ids is not None:
+            category_ids = set(int(c) for c in category_ids.split(','))
+    except ValueError:
+        return jsonify({"error": "Invalid category_id or Last-Event-ID"})
+    return getEventsAPI(since, category_ids)
+
+
+# Stream all categories and items as newline delimited JSON
+@app.route('/api/catalog/export')
+@auth.login_required
+def export_handler():
+    return Response(stream_with_context(exportCatalogAPI()),
+                    mimetype='application/x-ndjson')
+
+
 # Operate on a specific item
 @app.route('/api/catalog/item', methods=['GET', 'POST', 'PUT', 'DELETE'])
 @auth.login_required
 def add_item_handler():
     try:
-        category_id = request.json.get('category_id')
-        item_id = request.json.get('id')
-        item_name = request.json.get('name')
-        item_price = request.json.get('price')
-        item_description = request.json.get('description')
+        params = requestParams()
+        category_id = params.get('category_id')
+        item_id = params.get('id')
+        item_name = params.get('name')
+        item_price = params.get('price')
+        item_description = params.get('description')
+        try:
+            item_ids, field_names = multiGetParams(Item, params)
+        except ValueError:
+            return jsonify({"error": "Invalid ids or fields parameter"})
+
+        # Retreiving many items with key: ids
+        if item_ids and request.method == 'GET':
+            return getManyAPI(Item, 'items', item_ids, field_names)
 
         # Retreiving an item with key: id
-        if item_id and request.method == 'GET':
-            return getItemAPI(item_id)
+        elif item_id and request.method == 'GET':
+            return getItemAPI(item_id, field_names)
 
         # Creating new item with keys: category_id, name
         elif category_id and item_name and request.method == 'POST':
@@ -659,33 +992,171 @@ def add_item_handler():
         return jsonify({"error": "Invalid request, cannot operate on item"})
 
 
+# Apply many category operations in one request
+@app.route('/api/catalog/categories/batch', methods=['POST'])
+@auth.login_required
+def categories_batch_handler():
+    operations = batchOperations()
+    if operations is None:
+        return jsonify({"error": "Send a list of at most %s operations"
+                        % app.config['API_MAX_BATCH_SIZE']})
+    return batchCategoriesAPI(operations)
+
+
+# Apply many item operations in one request
+@app.route('/api/catalog/items/batch', methods=['POST'])
+@auth.login_required
+def items_batch_handler():
+    operations = batchOperations()
+    if operations is None:
+        return jsonify({"error": "Send a list of at most %s operations"
+                        % app.config['API_MAX_BATCH_SIZE']})
+    return batchItemsAPI(operations)
+
+
+# Hit and miss counters of the in process caches
+@app.route('/api/cache')
+@auth.login_required
+def cache_handler():
+    return jsonify(credentials=credential_cache.stats(),
+                   pages=page_cache.stats())
+
+
+# Connection pool usage, for sizing workers against the database
+@app.route('/api/pool')
+@auth.login_required
+def pool_handler():
+    return jsonify(pool=pool_metrics.snapshot(get_engine().pool),
+                   replicas=get_replicas().stats(),
+                   events=event_hub.stats())
+
+
+# Request timings and SQL statistics in the Prometheus text format
+@app.route('/metrics')
+@auth.login_required
+def metrics_handler():
+    return Response(render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 # Get all users info
 @app.route('/api/catalog/users')
 @auth.login_required
 def users_handler():
-    return getAllUsersAPI()
+    try:
+        limit = page_limit(request.args.get('limit'))
+        after = decode_cursor(request.args.get('after'), USER_ORDER)
+    except ValueError:
+        return jsonify({"error": "Invalid limit or after parameter"})
+    return getAllUsersAPI(limit, after)
 
 
 #############################
 # Methods for API endpoints #
 #############################
 
-def getAllCategoriesAPI():
+# Parameters of an API request: the JSON body, or the query string of a
+# GET request without one
+def requestParams():
+    params = request.get_json(silent=True)
+    if isinstance(params, dict):
+        return params
+    return request.args if request.method == 'GET' else {}
+
+
+# A list parameter, as a JSON list or comma separated text
+def listParam(params, name):
+    value = params.get(name)
+    if value is None or value == '':
+        return None
+    if not isinstance(value, list):
+        value = str(value).split(',')
+    return [str(v).strip() for v in value]
+
+
+# Return the ids and fields of a multi-get as lists, each None if absent.
+# Raises ValueError for ids that are not numbers, too many ids, or fields
+# the model does not serialize.
+def multiGetParams(model, params):
+    ids = listParam(params, 'ids')
+    if ids is not None:
+        ids = list(dict.fromkeys(int(i) for i in ids))
+        if len(ids) > app.config['API_MAX_PAGE_SIZE']:
+            raise ValueError('Too many ids')
+    field_names = listParam(params, 'fields')
+    if field_names is not None:
+        known = set(model.serialize_columns).union(
+            getattr(model, 'serialize_derived', {}))
+        if not known.issuperset(field_names):
+            raise ValueError('Unknown field')
+    return ids, field_names
+
+
+# Query of the columns needed to serialize fields, all if fields is None.
+# The primary key is always selected, and returned.
+def fieldsQuery(model, field_names):
+    if field_names is None:
+        return session.query(*serializeColumns(model))
+    derived = getattr(model, 'serialize_derived', {})
+    names = set(derived.get(f, f) for f in field_names)
+    names.add(inspect(model).primary_key[0].key)
+    return session.query(*[getattr(model, name)
+                           for name in model.serialize_columns
+                           if name in names])
+
+
+# Serialize a row of fieldsQuery, with only the requested fields
+def serializeFields(model, row, field_names):
+    if field_names is None:
+        return model.serialize_row(row)
+    values = dict.fromkeys(model.serialize_columns)
+    values.update(row._asdict())
+    key = inspect(model).primary_key[0].key
+    data = model.serialize_row(SimpleNamespace(**values))
+    return dict((name, data[name]) for name in data
+                if name in field_names or name == key)
+
+
+# Link to the next page of a list endpoint, or None on the last page
+def nextPageURL(endpoint, next_cursor, **args):
+    if next_cursor is None:
+        return None
+    return url_for(endpoint, after=next_cursor, _external=True, **args)
+
+
+def getAllCategoriesAPI(limit, after=None):
     try:
-        categories = session.query(Category).all()
+        categories, next_cursor = keyset_page(
+            session.query(*CATEGORY_COLUMNS), CATEGORY_ORDER, after, limit)
         if categories:
-            return jsonify(categories=[i.serialize for i in categories])
+            return encoding.jsonify(
+                categories=[Category.serialize_row(i) for i in categories],
+                next_cursor=next_cursor,
+                next=nextPageURL('categories_handler', next_cursor,
+                                 limit=limit))
         else:
             return jsonify({"error": "Cannot find any Categories"})
     except NoResultFound:
         return jsonify({"error": "Cannot retrive Categories"})
 
 
-def getCategoryAPI(category_id):
+# Get many categories or items by id in one query, in the order asked for
+def getManyAPI(model, name, ids, field_names=None):
+    key = inspect(model).primary_key[0]
+    rows = fieldsQuery(model, field_names).filter(key.in_(set(ids))).all()
+    found = dict((getattr(row, key.key), row) for row in rows)
+    return encoding.jsonify(**{
+        name: [serializeFields(model, found[i], field_names)
+               for i in ids if i in found],
+        'missing': [i for i in ids if i not in found]})
+
+
+def getCategoryAPI(category_id, field_names=None):
     try:
-        category = session.query(Category).filter_by(
-            category_id=category_id).one()
-        return jsonify(category=category.serialize)
+        category = fieldsQuery(Category, field_names).filter(
+            Category.category_id == category_id).one()
+        return jsonify(
+            category=serializeFields(Category, category, field_names))
 
     except NoResultFound:
         return jsonify({"error": "Cannot get category ID %s" % category_id})
@@ -702,6 +1173,8 @@ def addCategoryAPI(category_name):
             newCategory = Category(category_name=category_name,
                                    user_id=g.user.user_id)
             session.add(newCategory)
+            session.flush()
+            categoriesChanged([newCategory.category_id])
             session.commit()
             return jsonify(category=newCategory.serialize)
 
@@ -709,6 +1182,8 @@ def addCategoryAPI(category_name):
         newCategory = Category(category_name=category_name,
                                user_id=g.user.user_id)
         session.add(newCategory)
+        session.flush()
+        categoriesChanged([newCategory.category_id])
         session.commit()
         return jsonify(category=newCategory.serialize)
 
@@ -720,6 +1195,7 @@ def editCategoryAPI(category_id, category_name):
         if category.user_id == g.user.user_id:
             category.category_name = category_name
             session.add(category)
+            categoriesChanged([category.category_id])
             session.commit()
             return jsonify(category=category.serialize)
         else:
@@ -736,6 +1212,7 @@ def deleteCategoryAPI(category_id):
             category_id=category_id).one()
         if category.user_id == g.user.user_id:
             session.delete(category)
+            categoriesChanged([category_id])
             session.commit()
             return jsonify({
                 "message": "Category ID %s deleted" % category_id})
@@ -748,18 +1225,87 @@ def deleteCategoryAPI(category_id):
             "error": "cannot delete category ID %s" % category_id})
 
 
-def getAllItemsAPI(items):
+# Restrict an item query to a price range in cents, either end optional
+def priceFilter(query, min_price=None, max_price=None):
+    if min_price is not None:
+        query = query.filter(Item.item_price_cents >= min_price)
+    if max_price is not None:
+        query = query.filter(Item.item_price_cents <= max_price)
+    return query
+
+
+def getAllItemsAPI(limit, after=None, category_id=None,
+                   min_price=None, max_price=None, sort='date'):
+    order, descending = ITEM_SORTS[sort]
+    query = priceFilter(session.query(*ITEM_COLUMNS), min_price, max_price)
+    if category_id:
+        query = query.filter(Item.category_id == category_id)
+    if order is ITEM_PRICE_ORDER:
+        # Items without a price have no place in a price ordering
+        query = query.filter(Item.item_price_cents.isnot(None))
+    items, next_cursor = keyset_page(
+        query, order, after, limit, descending=descending)
     if items:
-        return jsonify(items=[i.serialize for i in items])
+        return encoding.jsonify(
+            items=[Item.serialize_row(i) for i in items],
+            next_cursor=next_cursor,
+            next=nextPageURL('items_handler', next_cursor,
+                             limit=limit, category_id=category_id,
+                             min_price=format_price(min_price),
+                             max_price=format_price(max_price),
+                             sort=sort if sort != 'date' else None))
     else:
         return jsonify({"error": "Cannot find any Items"})
 
 
-def getItemAPI(item_id):
+# Rows fetched per round trip while streaming the export
+EXPORT_BATCH_SIZE = 1000
+
+
+def exportCatalogAPI():
+    # Server side cursors keep memory flat however large the tables are
+    queries = [
+        ('category', session.query(Category).order_by(Category.category_id)),
+        ('item', session.query(Item).order_by(Item.item_id))
+    ]
+    for kind, query in queries:
+        query = query.execution_options(stream_results=True).yield_per(
+            EXPORT_BATCH_SIZE)
+        for row in query:
+            line = row.serialize
+            line['type'] = kind
+            yield flask_json.dumps(line) + '\n'
+
+
+def searchQuery(terms, category_id=None):
+    query = search_items(session, terms)
+    if category_id:
+        query = query.filter(Item.category_id == category_id)
+    return query
+
+
+def searchItemsAPI(terms, limit, page, category_id=None):
+    results = searchQuery(terms, category_id).limit(limit + 1).offset(
+        (page - 1) * limit).all()
+    items = []
+    for item, rank in results[:limit]:
+        found = item.serialize
+        found['rank'] = rank
+        items.append(found)
+    next_url = None
+    if len(results) > limit:
+        next_url = url_for('search_handler', q=terms, limit=limit,
+                           page=page + 1, category_id=category_id,
+                           _external=True)
+    return jsonify(items=items, page=page, next=next_url)
+
+
+def getItemAPI(item_id, field_names=None):
     try:
-        item = session.query(Item).filter_by(item_id=item_id).one()
+        item = fieldsQuery(Item, field_names).filter(
+            Item.item_id == item_id).one()
         if item:
-            return jsonify(item=item.serialize)
+            return jsonify(item=serializeFields(Item, item, field_names))
         else:
             return jsonify({"error": "Cannot find Item ID %s" % item_id})
     except NoResultFound:
@@ -767,15 +1313,21 @@ def getItemAPI(item_id):
 
 
 def addItemAPI(category_id, item_name, item_price, item_description):
+    try:
+        price_cents = parse_price(item_price)
+    except ValueError:
+        return jsonify({"error": "Price not valid: %s" % item_price})
     try:
         category = session.query(Category).filter_by(
             category_id=category_id).one()
         if category.user_id == g.user.user_id:
             newItem = Item(category_id=category_id,
                            item_name=item_name,
-                           item_price=item_price,
+                           item_price_cents=price_cents,
                            item_description=item_description)
             session.add(newItem)
+            session.flush()
+            itemsChanged([newItem.item_id], [category_id])
             session.commit()
             return jsonify(item=newItem.serialize)
         else:
@@ -788,8 +1340,14 @@ def addItemAPI(category_id, item_name, item_price, item_description):
 def editItemAPI(category_id, item_id, item_name,
                 item_price, item_description):
     try:
-        item = session.query(Item).filter_by(item_id=item_id).one()
+        price_cents = parse_price(item_price)
+    except ValueError:
+        return jsonify({"error": "Price not valid: %s" % item_price})
+    try:
+        item = session.query(Item).options(
+            joinedload(Item.category)).filter_by(item_id=item_id).one()
         if item.category.user_id == g.user.user_id:
+            old_category_id = item.category_id
             # If parameters are present, edit the item
             if item and category_id:
                 category = session.query(Category).filter_by(
@@ -805,11 +1363,12 @@ def editItemAPI(category_id, item_id, item_name,
                         for the item"})
             if item and item_name:
                 item.item_name = item_name
-            if item and item_price:
-                item.item_price = item_price
+            if item and price_cents is not None:
+                item.item_price_cents = price_cents
             if item and item_description:
                 item.item_description = item_description
             session.add(item)
+            itemsChanged([item.item_id], [old_category_id, item.category_id])
             session.commit()
             return jsonify(item=item.serialize)
         else:
@@ -821,9 +1380,12 @@ def editItemAPI(category_id, item_id, item_name,
 
 def deleteItemAPI(item_id):
     try:
-        item = session.query(Item).filter_by(item_id=item_id).one()
+        item = session.query(Item).options(
+            joinedload(Item.category)).filter_by(item_id=item_id).one()
         if item.category.user_id == g.user.user_id:
+            category_id = item.category_id
             session.delete(item)
+            itemsChanged([item_id], [category_id])
             session.commit()
             return jsonify({"message": "Deleted item with ID %s" % item_id})
         else:
@@ -832,11 +1394,313 @@ def deleteItemAPI(item_id):
         return jsonify({"error": "Cannot find item ID %s" % item_id})
 
 
-def getAllUsersAPI():
+##############################
+# Methods for batch requests #
+##############################
+
+# Return the list of operations in a batch request, or None if invalid
+def batchOperations():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None
+    operations = data.get('operations')
+    if (not isinstance(operations, list) or not operations or
+            len(operations) > app.config['API_MAX_BATCH_SIZE']):
+        return None
+    return [op if isinstance(op, dict) else {} for op in operations]
+
+
+def toInt(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Insert batch rows with one statement per set of columns, and set the
+# new primary key in each row
+def insertRows(model, rows):
+    key = inspect(model).primary_key[0]
+    insert = model.__table__.insert()
+    dialect = session.get_bind().dialect.name
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for names, group in groups.items():
+        if dialect == 'postgresql':
+            # RETURNING rows come in no promised order, so each id is
+            # matched to its row by the values inserted. Rows with the
+            # same values are interchangeable.
+            columns = [model.__table__.c[name] for name in names]
+            returned = {}
+            for values in session.execute(
+                    insert.values(group).returning(key, *columns)):
+                returned.setdefault(tuple(values[1:]), []).append(values[0])
+            for row in group:
+                row[key.name] = returned[
+                    tuple(row[name] for name in names)].pop()
+            continue
+        elif dialect == 'sqlite':
+            session.execute(insert, group)
+            # SQLite has one writer at a time and numbers new rows after
+            # the highest id, so the rows just inserted have the top ids
+            ids = [row_id for row_id, in session.query(key).order_by(
+                key.desc()).limit(len(group))][::-1]
+        else:
+            # Other databases fall back to one INSERT per row
+            session.bulk_insert_mappings(model, group, return_defaults=True)
+            continue
+        for row, row_id in zip(group, ids):
+            row[key.name] = row_id
+
+
+# Write the collected batch changes in a single transaction
+def applyBatch(model, inserts, updates, delete_queries, changed):
+    try:
+        if inserts:
+            insertRows(model, inserts)
+        if updates:
+            session.bulk_update_mappings(model, updates)
+        # Bulk writes skip the flush, so they are logged here
+        key = inspect(model).primary_key[0]
+        record_changes(session, model, 'insert',
+                       [(row[key.name], row['category_id'])
+                        for row in inserts])
+        if updates:
+            record_changes(session, model, 'update', session.query(
+                key, model.category_id).filter(
+                key.in_([row[key.name] for row in updates])))
+        for query in delete_queries:
+            deleted_model = query.column_descriptions[0]['entity']
+            deleted_key = inspect(deleted_model).primary_key[0]
+            record_changes(session, deleted_model, 'delete',
+                           query.with_entities(deleted_key,
+                                               deleted_model.category_id))
+            query.delete(synchronize_session=False)
+        changed()
+        session.commit()
+        return True
+    except SQLAlchemyError:
+        session.rollback()
+        return False
+
+
+def batchCategoriesAPI(operations):
+    user_id = g.user.user_id
+    category_ids = set(toInt(op.get('id')) for op in operations) - {None}
+    names = set(op.get('name') for op in operations
+                if op.get('op') == 'create' and op.get('name'))
+
+    # Validate ownership of all categories in one query
+    owners = {}
+    if category_ids:
+        owners = dict(session.query(
+            Category.category_id, Category.user_id).filter(
+            Category.category_id.in_(category_ids)))
+    existing = set()
+    if names:
+        existing = set(name for name, in session.query(
+            Category.category_name).filter(
+            Category.user_id == user_id,
+            Category.category_name.in_(names)))
+
+    results = []
+    inserts = []
+    updates = []
+    deletes = []
+    for index, op in enumerate(operations):
+        action = op.get('op')
+        category_id = toInt(op.get('id'))
+        name = op.get('name')
+        result = {"index": index, "op": action}
+        results.append(result)
+        if action == 'create':
+            if not name:
+                result['error'] = "Missing name"
+            elif name in existing:
+                result['error'] = "You already have category %s" % name
+            else:
+                existing.add(name)
+                inserts.append({'category_name': name, 'user_id': user_id,
+                                '_result': result})
+            continue
+        if action not in ('update', 'delete'):
+            result['error'] = "Unknown operation"
+        elif category_id not in owners:
+            result['error'] = "Cannot access Category ID %s" % op.get('id')
+        elif owners[category_id] != user_id:
+            result['error'] = "You can only change your own categories"
+        elif action == 'update' and not name:
+            result['error'] = "Missing name"
+        elif action == 'update':
+            updates.append({'category_id': category_id,
+                            'category_name': name})
+            result['id'] = category_id
+        else:
+            deletes.append(category_id)
+            result['id'] = category_id
+
+    delete_queries = []
+    if deletes:
+        # Items go first, as the category rows are removed in bulk
+        delete_queries = [
+            session.query(Item).filter(Item.category_id.in_(deletes)),
+            session.query(Category).filter(Category.category_id.in_(deletes))
+        ]
+    results_of_inserts = [row.pop('_result') for row in inserts]
+
+    # Called once the new rows have their ids
+    def changed():
+        categoriesChanged([row['category_id'] for row in inserts] +
+                          [row['category_id'] for row in updates] + deletes)
+
+    if not applyBatch(Category, inserts, updates, delete_queries, changed):
+        return jsonify({"error": "Batch failed, no categories were changed"})
+    for row, result in zip(inserts, results_of_inserts):
+        result['id'] = row['category_id']
+    return jsonify(results=results)
+
+
+def batchItemsAPI(operations):
+    user_id = g.user.user_id
+    item_ids = set(toInt(op.get('id')) for op in operations) - {None}
+    category_ids = set(
+        toInt(op.get('category_id')) for op in operations) - {None}
+
+    # Validate ownership of all items and categories in one query
+    item_match = Item.item_id.in_(item_ids) if item_ids else false()
+    category_match = (Category.category_id.in_(category_ids)
+                      if category_ids else false())
+    owners = {}
+    item_owners = {}
+    item_categories = {}
+    rows = session.query(
+        Category.category_id, Category.user_id, Item.item_id).outerjoin(
+        Item, and_(Item.category_id == Category.category_id,
+                   item_match)).filter(or_(category_match, item_match))
+    for row_category_id, row_user_id, row_item_id in rows:
+        owners[row_category_id] = row_user_id
+        if row_item_id is not None:
+            item_owners[row_item_id] = row_user_id
+            item_categories[row_item_id] = row_category_id
+
+    results = []
+    inserts = []
+    updates = []
+    deletes = []
+    for index, op in enumerate(operations):
+        action = op.get('op')
+        item_id = toInt(op.get('id'))
+        category_id = toInt(op.get('category_id'))
+        result = {"index": index, "op": action}
+        results.append(result)
+        values = {}
+        if op.get('name'):
+            values['item_name'] = op['name']
+        if op.get('description'):
+            values['item_description'] = op['description']
+        try:
+            if op.get('price'):
+                values['item_price_cents'] = parse_price(op['price'])
+            price_valid = True
+        except ValueError:
+            price_valid = False
+
+        if action not in ('create', 'update', 'delete'):
+            result['error'] = "Unknown operation"
+        elif not price_valid:
+            result['error'] = "Price not valid: %s" % op.get('price')
+        elif action != 'create' and item_id not in item_owners:
+            result['error'] = "Cannot find item ID %s" % op.get('id')
+        elif action != 'create' and item_owners[item_id] != user_id:
+            result['error'] = "You can only change your own items"
+        elif category_id is not None and category_id not in owners:
+            result['error'] = "Category ID not valid: %s" % op.get(
+                'category_id')
+        elif category_id is not None and owners[category_id] != user_id:
+            result['error'] = "You can only use your own categories"
+        elif action == 'create' and not (category_id and 'item_name' in values):
+            result['error'] = "Missing category_id or name"
+        elif action == 'create':
+            values['category_id'] = category_id
+            values['_result'] = result
+            inserts.append(values)
+        elif action == 'update':
+            if category_id is not None:
+                values['category_id'] = category_id
+            if values:
+                values['item_id'] = item_id
+                updates.append(values)
+            result['id'] = item_id
+        else:
+            deletes.append(item_id)
+            result['id'] = item_id
+
+    delete_queries = []
+    if deletes:
+        delete_queries = [
+            session.query(Item).filter(Item.item_id.in_(deletes))]
+    results_of_inserts = [row.pop('_result') for row in inserts]
+
+    # Called once the new rows have their ids
+    def changed():
+        itemsChanged(
+            [row['item_id'] for row in inserts + updates] + deletes,
+            [item_categories[i] for i in deletes] +
+            [row['category_id'] for row in inserts + updates
+             if 'category_id' in row] +
+            [item_categories[row['item_id']] for row in updates])
+
+    if not applyBatch(Item, inserts, updates, delete_queries, changed):
+        return jsonify({"error": "Batch failed, no items were changed"})
+    for row, result in zip(inserts, results_of_inserts):
+        result['id'] = row['item_id']
+    return jsonify(results=results)
+
+
+def getChangesAPI(since, limit):
+    changes, more = changes_since(session, since, limit)
+    last_seq = changes[-1].change_id if changes else since
+    return jsonify(
+        changes=change_entries(session, changes),
+        last_seq=last_seq,
+        latest_seq=session.query(func.max(Change.change_id)).scalar() or 0,
+        next=url_for('changes_handler', since=last_seq, limit=limit,
+                     _external=True) if more else None)
+
+
+def getEventsAPI(since, category_ids):
+    # Replicas may lag behind, and the stream must not skip a change
+    use_primary()
+    latest_seq = session.query(func.max(Change.change_id)).scalar() or 0
+    session.remove()
+    subscription = event_hub.subscribe(
+        category_ids, latest_seq if since is None else since, latest_seq)
+    if subscription is None:
+        response = make_response(
+            json.dumps('Too many event streams, try again later'), 503)
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['Retry-After'] = str(
+            app.config['EVENTS_HEARTBEAT'])
+        return response
+    # Not stream_with_context: the stream holds no request, session or
+    # database connection while it waits for events
+    response = Response(event_stream(subscription),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def getAllUsersAPI(limit, after=None):
     try:
-        users = session.query(UserAccount).all()
+        users, next_cursor = keyset_page(
+            session.query(*USER_COLUMNS), USER_ORDER, after, limit)
         if users:
-            return jsonify(users=[i.serialize for i in users])
+            return encoding.jsonify(
+                users=[UserAccount.serialize_row(i) for i in users],
+                next_cursor=next_cursor,
+                next=nextPageURL('users_handler', next_cursor, limit=limit))
         else:
             return jsonify({"error": "Cannot find any Users"})
     except NoResultFound:
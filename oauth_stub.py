@@ -0,0 +1,92 @@
+"""Local stand-in for Google's OAuth endpoints, for offline load tests.
+
+Any authorization code is accepted. The code names the user, so logging
+in with code 'user42' creates the user 'Stub user42'. Start it with:
+
+    python oauth_stub.py --client-id YOUR_CLIENT_ID --port 8001
+
+and point the app at it with a client_secrets.json whose token_uri is
+http://localhost:8001/token, and these environment variables:
+
+    OAUTH_TOKENINFO_URL=http://localhost:8001/tokeninfo
+    OAUTH_USERINFO_URL=http://localhost:8001/userinfo
+    OAUTH_REVOKE_URL=http://localhost:8001/revoke
+    GOOGLE_CERTS_URL=http://localhost:8001/certs
+
+The stub's ID tokens are unsigned, so the app always checks them with the
+tokeninfo endpoint, as it does when Google's certificates are unavailable.
+"""
+import argparse
+import base64
+import json
+import time
+
+from flask import Flask, jsonify, request
+
+
+stub = Flask(__name__)
+
+
+def encode_segment(data):
+    raw = json.dumps(data).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def user_from_token(access_token):
+    return access_token[len('stub-'):]
+
+
+@stub.route('/token', methods=['POST'])
+def token():
+    code = request.form.get('code', 'user')
+    # oauth2client reads the id_token payload without checking signatures
+    id_token = '.'.join([
+        encode_segment({'alg': 'none', 'typ': 'JWT'}),
+        encode_segment({'sub': 'stub-%s' % code,
+                        'aud': stub.config['CLIENT_ID'],
+                        'iss': 'https://accounts.google.com',
+                        'iat': int(time.time()),
+                        'exp': int(time.time()) + 3600}),
+        encode_segment('stub')])
+    return jsonify(access_token='stub-%s' % code,
+                   token_type='Bearer',
+                   expires_in=3600,
+                   id_token=id_token)
+
+
+@stub.route('/tokeninfo')
+def tokeninfo():
+    access_token = request.args.get('access_token', '')
+    if not access_token.startswith('stub-'):
+        return jsonify(error='invalid_token'), 400
+    return jsonify(user_id='stub-%s' % user_from_token(access_token),
+                   issued_to=stub.config['CLIENT_ID'],
+                   expires_in=3600)
+
+
+@stub.route('/userinfo')
+def userinfo():
+    user = user_from_token(request.args.get('access_token', ''))
+    return jsonify(name='Stub %s' % user,
+                   email='%s@example.com' % user,
+                   picture='https://example.com/%s.png' % user)
+
+
+@stub.route('/certs')
+def certs():
+    return jsonify({})
+
+
+@stub.route('/revoke')
+def revoke():
+    return jsonify(revoked=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--client-id', required=True,
+                        help='client_id of the app in client_secrets.json')
+    parser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+    stub.config['CLIENT_ID'] = args.client_id
+    stub.run(host='127.0.0.1', port=args.port, threaded=True)
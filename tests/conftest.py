@@ -0,0 +1,7 @@
+import os
+
+# Settings read when the app is imported. The page cache is off, so every
+# request reaches the database.
+os.environ['RESPONSE_CACHE_BACKEND'] = 'none'
+os.environ['SECRET_KEY'] = 'test'
+os.environ['DATABASE_REPLICA_URLS'] = ''
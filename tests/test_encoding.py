@@ -0,0 +1,38 @@
+"""The orjson encoder of the list endpoints writes the JSON Flask does."""
+import datetime
+
+import pytest
+from flask import jsonify as flask_jsonify
+
+from item_catalog_app import app, encoding
+
+pytest.importorskip('orjson')
+
+DATA = {
+    'items': [{
+        'item_name': u'Café crème   \U0001F600',
+        'item_description': u'Tab\tquote" back\\slash \x01 </script>',
+        'item_date': datetime.datetime(2019, 7, 1, 12, 30),
+        'item_price': None,
+        'item_id': 1,
+    }],
+    'next': u'日本',
+}
+
+
+@pytest.mark.parametrize('as_ascii', [True, False])
+def test_same_json_as_flask(as_ascii):
+    app.config['JSON_AS_ASCII'] = as_ascii
+    try:
+        with app.test_request_context():
+            assert encoding.use_orjson()
+            expected = flask_jsonify(**DATA).get_data()
+            assert encoding.jsonify(**DATA).get_data() == expected
+    finally:
+        app.config['JSON_AS_ASCII'] = True
+
+
+def test_non_ascii_escaped():
+    with app.test_request_context():
+        body = encoding.jsonify(name=u'Café \U0001F600').get_data()
+    assert body == b'{"name":"Caf\\u00e9 \\ud83d\\ude00"}\n'
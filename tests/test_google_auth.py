@@ -0,0 +1,59 @@
+"""Google's signing certificates are fetched rarely, even when Google is
+down."""
+import pytest
+import requests
+
+from item_catalog_app import google_auth
+
+
+class FakeResponse(object):
+    headers = {'Cache-Control': 'public, max-age=100'}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'key': 'certificate'}
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    calls = []
+    clock = [1000.0]
+    failing = []
+
+    def get(url):
+        calls.append(clock[0])
+        if failing:
+            raise requests.ConnectionError('Google is down')
+        return FakeResponse()
+
+    monkeypatch.setattr(google_auth.http_client, 'get', get)
+    monkeypatch.setattr(google_auth.time, 'time', lambda: clock[0])
+    return calls, clock, failing
+
+
+def test_keeps_certificates_and_backs_off(fetches):
+    calls, clock, fail = fetches
+    cache = google_auth.CertificateCache()
+    assert cache.get() == {'key': 'certificate'}
+    clock[0] += 101
+    fail.append(True)
+    # The old certificates are kept, and Google is not asked again
+    # until the retry interval has passed
+    assert cache.get() == {'key': 'certificate'}
+    assert cache.get() == {'key': 'certificate'}
+    assert len(calls) == 2
+    clock[0] += google_auth.app.config['GOOGLE_CERTS_RETRY'] + 1
+    cache.get()
+    assert len(calls) == 3
+
+
+def test_backs_off_without_certificates(fetches):
+    calls, clock, fail = fetches
+    fail.append(True)
+    cache = google_auth.CertificateCache()
+    for attempt in range(3):
+        with pytest.raises(requests.RequestException):
+            cache.get()
+    assert len(calls) == 1
@@ -0,0 +1,23 @@
+"""Secrets are kept out of the log."""
+from item_catalog_app.logs import redact, redact_text
+
+
+def test_redact_fields():
+    assert redact({
+        'password': 'p', 'api_token': 't', 'code': 'c', 'oauth_code': 'c',
+        'State': 's', 'status_code': 200, 'statement': 'SELECT 1',
+        'user_id': 1,
+    }) == {
+        'password': '[redacted]', 'api_token': '[redacted]',
+        'code': '[redacted]', 'oauth_code': '[redacted]',
+        'State': '[redacted]', 'status_code': 200, 'statement': 'SELECT 1',
+        'user_id': 1,
+    }
+
+
+def test_redact_text():
+    assert redact_text(
+        'GET /oauth/google?code=abc&state=xyz&access_token=t '
+        'status_code=200 error_code=5') == (
+        'GET /oauth/google?code=[redacted]&state=[redacted]'
+        '&access_token=[redacted] status_code=200 error_code=5')
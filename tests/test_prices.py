@@ -0,0 +1,49 @@
+"""Prices typed by users, read as integer cents."""
+import pytest
+from sqlalchemy import create_engine
+
+from item_catalog_app.migrations import copy_text_prices
+from item_catalog_app.models import format_price, parse_price
+
+
+@pytest.mark.parametrize('value, cents', [
+    (None, None),
+    ('  ', None),
+    ('12', 1200),
+    ('12.5', 1250),
+    ('$ 12.50', 1250),
+    ('12,50 EUR', 1250),
+    ('€5', 500),
+    ('1,000.00', 100000),
+    ('1.000,00', 100000),
+    ("1'000", 100000),
+])
+def test_parse_price(value, cents):
+    assert parse_price(value) == cents
+
+
+@pytest.mark.parametrize('value', [
+    '-3', '+3', '$-3', 'abc12', '12xyz', '12 usd', '1.000.00', '1,00,000',
+    '1234567890',
+])
+def test_parse_price_rejects(value):
+    with pytest.raises(ValueError):
+        parse_price(value)
+
+
+def test_format_price():
+    assert format_price(parse_price('1.234,5')) == '1234.50'
+    assert format_price(None) is None
+
+
+def test_copy_text_prices_skips_invalid():
+    engine = create_engine('sqlite://')
+    with engine.connect() as conn:
+        conn.execute('CREATE TABLE item (item_id INTEGER PRIMARY KEY, '
+                     'item_price VARCHAR, item_price_cents INTEGER)')
+        conn.execute('INSERT INTO item (item_price) VALUES '
+                     "('1,000.00'), ('-3'), ('abc12'), (NULL)")
+        assert copy_text_prices(conn) == [2, 3]
+        assert [cents for cents, in conn.execute(
+            'SELECT item_price_cents FROM item ORDER BY item_id')] == [
+            100000, None, None, None]
@@ -0,0 +1,82 @@
+"""Number of SQL statements run by the catalog pages and API endpoints.
+
+Each page loads the relationships it renders up front, so the counts do
+not grow with the number of rows shown. Run from the repository root:
+
+    python -m pytest tests
+"""
+import base64
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from item_catalog_app import create_app
+from item_catalog_app.database import count_queries, db_session
+from item_catalog_app.migrations import init_db
+from item_catalog_app.models import Category, Item, UserAccount
+
+
+USERS = 3
+CATEGORIES_PER_USER = 3
+ITEMS_PER_CATEGORY = 5
+
+
+@pytest.fixture(scope='module')
+def client():
+    directory = tempfile.mkdtemp()
+    app = create_app({'DATABASE_URL': 'sqlite:///' + os.path.join(
+        directory, 'catalog.db')})
+    init_db()
+    for u in range(USERS):
+        user = UserAccount(user_name='user%d' % u,
+                           user_email='user%d@example.com' % u)
+        user.hash_password('password')
+        db_session.add(user)
+        db_session.flush()
+        for c in range(CATEGORIES_PER_USER):
+            category = Category(category_name='category%d%d' % (u, c),
+                                user_id=user.user_id)
+            db_session.add(category)
+            db_session.flush()
+            for i in range(ITEMS_PER_CATEGORY):
+                db_session.add(Item(
+                    item_name='item%d%d%d' % (u, c, i),
+                    item_description='Description',
+                    item_price_cents=i * 100 + 50,
+                    category_id=category.category_id))
+    db_session.commit()
+    db_session.remove()
+    yield app.test_client()
+    db_session.remove()
+    shutil.rmtree(directory)
+
+
+AUTH = {'Authorization': 'Basic ' + base64.b64encode(
+    b'user0:password').decode('ascii')}
+
+
+@pytest.mark.parametrize('url, headers, statements', [
+    ('/catalog', {}, 3),
+    ('/catalog/category00/1', {}, 3),
+    ('/catalog/category00/item000/1', {}, 2),
+    ('/catalog/search?q=item000', {}, 2),
+    ('/api/catalog/categories', {}, 2),
+    ('/api/catalog/items', {}, 2),
+    ('/api/catalog/users', AUTH, 2),
+    ('/api/catalog/category?id=1', AUTH, 2),
+    ('/api/catalog/category?ids=1,2,3', AUTH, 2),
+    ('/api/catalog/item?id=1', AUTH, 2),
+    ('/api/catalog/item?ids=1,2,3', AUTH, 2),
+    ('/api/catalog/export', AUTH, 3),
+])
+def test_statement_count(client, url, headers, statements):
+    # The first request warms up the connection and credential caches
+    client.get(url, headers=headers).get_data()
+    with count_queries() as counter:
+        response = client.get(url, headers=headers)
+        # Streamed responses query while the body is read
+        response.get_data()
+    assert response.status_code == 200
+    assert counter['count'] == statements
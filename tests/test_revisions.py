@@ -0,0 +1,33 @@
+"""Revision counters, bumped in the transaction of the write."""
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from item_catalog_app.models import Revision
+from item_catalog_app.revisions import bump_revisions, current_revisions
+
+
+def make_session():
+    engine = create_engine('sqlite://')
+    Revision.__table__.create(engine)
+    return sessionmaker(bind=engine)()
+
+
+def test_bump_revisions():
+    session = make_session()
+    bump_revisions(session, ['items', 'item:1'])
+    session.commit()
+    bump_revisions(session, ['items', 'item:2'])
+    session.commit()
+    revisions, modified = current_revisions(
+        session, ['items', 'item:1', 'item:2', 'item:3'])
+    assert revisions == [2, 1, 1, 0]
+    assert modified is not None
+
+
+def test_bump_revisions_rolls_back_with_the_write():
+    session = make_session()
+    bump_revisions(session, ['items'])
+    session.commit()
+    bump_revisions(session, ['items', 'item:1'])
+    session.rollback()
+    assert current_revisions(session, ['items', 'item:1'])[0] == [1, 0]